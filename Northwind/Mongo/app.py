@@ -8,9 +8,19 @@
 
 import datetime
 import os
+import sys
 
-from flask import Flask, render_template, request, jsonify, redirect
+from bson.objectid import ObjectId
+from flask import Flask, Response, abort, render_template, request, jsonify, redirect, stream_with_context
 from flask_pymongo import PyMongo
+from pymongo.collation import Collation
+
+# cache.py is shared with the rest of the repo, and lives at the top of it.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+import counters
+import order_view
+from cache import FragmentCache, LRUCache
 
 # Since I'm not a huge fan of putting passwords in plain code,
 # I've placed it in a environment variable saved under 'mongo_atlas_password'
@@ -18,9 +28,19 @@ password = os.environ.get('mongo_atlas_password')
 username = 'najarvis'
 
 app = Flask(__name__)
+
+# Rendered html for single documents, shared by every request. Templates use it
+# through fragment(). See cache.FragmentCache.
+FRAGMENT_CACHE = FragmentCache(maxsize=4096)
+FRAGMENT_CACHE.install(app)
+
 # Connect to Atlas. These lines need to come before we initialize PyMongo.
-app.config['MONGO_HOST'] = 'mongodb+srv://' + username + ':' + password + \
-                           '@learningatlas01-1cf8c.gcp.mongodb.net/test?retryWrites=true'
+# Set 'mongo_uri' to use another server instead (e.g. a local one for benchmarking).
+if os.environ.get('mongo_uri'):
+    app.config['MONGO_URI'] = os.environ.get('mongo_uri')
+else:
+    app.config['MONGO_HOST'] = 'mongodb+srv://' + username + ':' + password + \
+                               '@learningatlas01-1cf8c.gcp.mongodb.net/test?retryWrites=true'
 app.config['MONGO_DBNAME'] = 'Northwind'
 
 mongo = PyMongo(app)
@@ -29,6 +49,38 @@ mongo = PyMongo(app)
 def index():
     return redirect('/search')
 
+# Product search. Names are matched from the start, ignoring case. ProductName
+# is indexed with a case-insensitive collation, and searching with the same
+# collation turns "starts with" into a range seek on that index. Products
+# added later by anything (mongorestore, imports, the shell) are indexed as
+# they're written, so nothing has to be filled in first. Results are cached per
+# search string for SEARCH_TTL seconds. Those writers can't clear the cache, so
+# that's how out of date a search (and the stock it shows) can be.
+SEARCH_COLLATION = Collation(locale='en', strength=2)
+SEARCH_TTL = 30
+SEARCH_CACHE = LRUCache(maxsize=1024, ttl=SEARCH_TTL)
+
+@app.before_first_request
+def build_search_index():
+    """Creates the index search_products() uses. Does nothing if it's already there."""
+    mongo.db.products.create_index("ProductName", name="ProductName_search",
+                                   collation=SEARCH_COLLATION)
+
+def prefix_range(prefix):
+    """Query for every string starting with prefix. U+FFFF sorts after every
+    other character, so nothing that starts with the prefix is past the end."""
+    return {"$gte": prefix, "$lt": prefix + "\uffff"}
+
+def search_products(search_string):
+    """Returns every product whose name starts with search_string, ignoring case."""
+    key = search_string.lower()
+
+    def load():
+        return list(mongo.db.products.find({"ProductName": prefix_range(key)}, {'_id': 0},
+                                           collation=SEARCH_COLLATION))
+
+    return SEARCH_CACHE.get_or_load(key, load)
+
 @app.route('/search', methods=['GET', 'POST'])
 def search():
     """Search for and display products."""
@@ -38,31 +90,63 @@ def search():
 
     # Execute the following code if it is a POST request.
     search_string = request.form.get('data')
-    regex = {"$regex": '.*' + search_string + '.*', '$options': 'i'}
-    results = mongo.db.products.find({"ProductName": regex}, {'_id': 0})
+    results = search_products(search_string)
 
-    # Render a template for each product, then combine them into one long string
-    # and send to the user.
-    rendered_sections = []
-    for result in results:
-        rendered_sections.append(render_template('product.html', product=result))
+    # Render every product in one pass and send to the user. Products shown in
+    # the last minute reuse their cached html.
+    return jsonify(render_template('product_list.html', products=results))
 
-    return jsonify("\n".join(rendered_sections))
+# How many documents /raw shows at once.
+RAW_PAGE_SIZE = 100
+
+def stream_template(template_name, **context):
+    """Like render_template, but sends the page to the client bit by bit as it
+    is rendered instead of building the whole thing in memory first. Any
+    generators passed in are only read as the page is sent."""
+    app.update_template_context(context)
+    template = app.jinja_env.get_template(template_name)
+    return Response(stream_with_context(template.generate(context)))
 
 @app.route('/raw/<collection>')
 @app.route('/raw')
 def raw(collection='orders'):
-    """A raw view of the entire contents of a collection."""
+    """A raw view of the contents of a collection, one page at a time.
 
-    # Render a template for each document in the collection specified by the url.
-    data_arr = []
-    for result in mongo.db[collection].find({}, {"_id": 0}):
-        data_arr.append(render_template("generic_document.html", document=result))
-    raw_html = "\n".join(data_arr)
+    Pages are found with the _id of the last document on the previous page
+    (?after=<_id>) rather than skipping, so the last page is as quick as the
+    first. Add ?stream=1 to stream the whole collection instead."""
 
     collections = mongo.db.collection_names()
 
-    return render_template("raw.html", data=raw_html, collections=collections)
+    if request.args.get('stream'):
+        documents = mongo.db[collection].find({}, {"_id": 0})
+        return stream_template("raw.html", documents=documents,
+                               collections=collections, next_page=None)
+
+    query = {}
+    after = request.args.get('after')
+    if after:
+        if not ObjectId.is_valid(after):
+            abort(400)
+        query['_id'] = {'$gt': ObjectId(after)}
+    # Mongo reads a limit of 0 as no limit at all, so keep it to one page.
+    limit = min(max(request.args.get('limit', RAW_PAGE_SIZE, type=int), 1), RAW_PAGE_SIZE)
+    documents = list(mongo.db[collection].find(query).sort('_id', 1).limit(limit))
+
+    # Only link to another page if this one was full.
+    next_page = str(documents[-1]['_id']) if len(documents) == limit else None
+    for document in documents:
+        del document['_id']
+
+    return render_template("raw.html", documents=documents,
+                           collections=collections, next_page=next_page)
+
+# OrderIDs come from a counter document that is incremented atomically, so two
+# orders placed at the same time can't get the same ID. See counters.py.
+
+@app.before_first_request
+def init_order_counter():
+    counters.init_order_counter(mongo.db)
 
 @app.route('/order/<order_string>', methods=['GET', 'POST'])
 @app.route('/order', methods=['GET', 'POST'])
@@ -83,30 +167,37 @@ def order(order_string=""):
     if customer_data is None:
         return "Customer not found!"
 
-    # Find the largest order number and increment it to get the next order_number.
-    # NOTE: This does not guaruntee that the OrderID is unique, if another user runs
-    # this query before this route finishes.
-    order_num = next(mongo.db.orders.find().sort('OrderID', -1).limit(1)).get('OrderID') + 1
-
     products_requested = request.form.get('prod_id')
     # Convert the string into individual ints.
     product_data = list(map(int, products_requested.split(',')))
     if len(product_data) % 2:
         return "Invalid input. There should be even number of products and quanities."
 
+    # Every other element is a product ID, the ones in between are quantities.
+    line_items = list(zip(product_data[0::2], product_data[1::2]))
+
+    # Grab every product in the order, along with its category's name, with a
+    # single query. The order's view is built from the same documents, so it
+    # doesn't have to fetch them again.
+    product_ids = list({product_id for product_id, _ in line_items})
+    product_docs = order_view.find_products(mongo.db, product_ids)
+
+    missing = [str(product_id) for product_id in product_ids if product_id not in product_docs]
+    if missing:
+        return "Products not found: " + ", ".join(missing)
+
     # Build each of the product subdocuments, place them in a list
     products = []
-    for i in range(len(product_data) // 2):
-        product_id = product_data[2*i]
-        quantity = product_data[2*i+1]
-        product_doc = mongo.db.products.find_one({'ProductID': product_id})
+    for product_id, quantity in line_items:
         products.append({
             'ProductID': product_id,
-            'UnitPrice': product_doc.get('UnitPrice'),
+            'UnitPrice': product_docs[product_id].get('UnitPrice'),
             'Quantity': quantity,
             'Discount': 0
         })
 
+    order_num = counters.next_order_id(mongo.db)
+
     # Create the document that will be inserted into the database.
     order_dict = {
         'OrderID': order_num,
@@ -126,26 +217,25 @@ def order(order_string=""):
     }
 
     # Insert into the databse.
-    mongo.db.mongo_orders.insert(order_dict)
+    mongo.db.mongo_orders.insert_one(order_dict)
+    order_view.refresh_orders(mongo.db, [order_dict], product_docs)
     return redirect('/raw/mongo_orders')
 
 @app.route('/render_cart', methods=['POST'])
 def render_cart():
-    """Renders a template for each item in the cart, then returns them
-    concatonated together. Directly placed into page via JQuery."""
+    """Renders every item in the cart with a single template, then returns it.
+    Directly placed into page via JQuery."""
 
     # For some reason even though we specify "json" as the content type in
     # JavaScript, we still need to use 'force=True' to ignore headers and interpret as json.
     cart = request.get_json(force=True)
-    rendered = []
-    for cart_item in cart:
-        quantity = cart_item.get('quantity')
-        name = cart_item.get('name')
-        rendered.append(render_template('cart_item.html',
-                                        name=name,
-                                        quantity=quantity))
 
-    return jsonify("\n".join(rendered))
+    # cart_list.html renders every item in one pass.
+    return jsonify(render_template('cart_list.html', cart=cart))
+
+@app.before_first_request
+def create_order_view_indexes():
+    order_view.create_indexes(mongo.db)
 
 @app.route('/expand_order/<order_id>')
 @app.route('/expand_order')
@@ -157,24 +247,14 @@ def expand_order(order_id=None):
     if order_id is None:
         return render_template("expand.html", order=None)
 
-    # Collect all the data from mongo.
-    order_data = mongo.db.mongo_orders.find_one({"OrderID": int(order_id)}, {"_id": 0})
-    print(order_data)
-    products = order_data.get('Products')
-
-    # We grab each of the ids for the products, then do a single mongo query for
-    # them, rather than doing a query for each id individualy.
-    id_dict = {product.get('ProductID'): product for product in products}
-    products_data = mongo.db.products.find({"ProductID": {"$in": list(id_dict)}}, {"_id": 0})
-
-    # Render templates for the order and products.
-    order_template = render_template("generic_document.html", document=order_data)
-    templates = []
-    for pd in products_data:
-        # Combine the two dictionaries
-        full_doc = {}
-        full_doc.update(pd)
-        full_doc.update(id_dict.get(pd.get('ProductID')))
-        templates.append(render_template("generic_document.html", document=full_doc))
-
-    return render_template("expand.html", order=order_template, products="\n".join(templates))
+    # Order views already have every product filled in, so this is one indexed
+    # read. Orders placed before the view existed get one written the first
+    # time they're looked at. See order_view.py.
+    order_data = mongo.db.order_views.find_one({"OrderID": int(order_id)}, {"_id": 0})
+    if order_data is None:
+        order_data = order_view.refresh_order(mongo.db, int(order_id))
+    if order_data is None:
+        return "Order not found!"
+
+    # Render the order and products in one pass.
+    return render_template("expand.html", order=order_data, products=order_data['Products'])
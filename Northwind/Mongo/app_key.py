@@ -8,16 +8,26 @@
 
 import datetime
 import os
+import sys
 
-from flask import Flask, render_template, request, jsonify, redirect
+from bson.objectid import ObjectId
+from flask import Flask, abort, render_template, request, jsonify, redirect
 from flask_pymongo import PyMongo
 
+# cache.py is shared with the rest of the repo, and lives at the top of it.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+import counters
+import order_view
+from cache import ReferenceCache
+
 # Since I'm not a huge fan of putting passwords in plain code,
 # I've placed it in a environment variable saved under 'mongo_atlas_password'
 password = os.environ.get('mongo_atlas_password')
 username = 'najarvis'
 
 app = Flask(__name__)
+
 # Connect to Atlas. These lines need to come before we initialize PyMongo.
 app.config['MONGO_HOST'] = 'mongodb+srv://' + username + ':' + password + \
                            '@learningatlas01-1cf8c.gcp.mongodb.net/test?retryWrites=true'
@@ -25,6 +35,28 @@ app.config['MONGO_DBNAME'] = 'Northwind'
 
 mongo = PyMongo(app)
 
+# Lookup tables for reference data that almost never changes. Each maps an ID
+# to a name. They're loaded the first time they're needed, then kept for every
+# request until they expire or the number of documents changes.
+REFERENCE_CACHE = ReferenceCache(ttl=600, check_interval=30)
+
+def register_reference_table(collection, id_field, name_field):
+    def load():
+        docs = mongo.db[collection].find({}, {id_field: 1, name_field: 1})
+        return {doc[id_field]: doc[name_field] for doc in docs}
+
+    REFERENCE_CACHE.register(collection, load, lambda: mongo.db[collection].count())
+
+register_reference_table('categories', 'CategoryID', 'CategoryName')
+register_reference_table('suppliers', 'SupplierID', 'CompanyName')
+register_reference_table('shippers', 'ShipperID', 'CompanyName')
+register_reference_table('regions', 'RegionID', 'RegionDescription')
+
+@app.route('/metrics')
+def metrics():
+    """Hit rate and size of the reference data cache."""
+    return jsonify(REFERENCE_CACHE.stats())
+
 @app.route('/')
 def index():
     return redirect('/search')
@@ -37,14 +69,13 @@ def search():
         return render_template("search.html")
 
     # Diff
-    # Grab all category names and IDs
-    categories = mongo.db.categories.find({}, {"CategoryID": 1, "CategoryName": 1})
+    # A mapping between the category IDs and the category names. This comes from
+    # the reference cache, so the categories collection is only read when the
+    # cache is empty or out of date rather than on every search.
+    category_dict = REFERENCE_CACHE.get('categories')
 
-    # Diff
-    # Iterate through and create a mapping between the IDs and the category names.
-    category_dict = {cat["CategoryID"]: cat["CategoryName"] for cat in categories}
-
-    # Simpler Solution to the line above.
+    # Without the cache, this is how we'd build it each time:
+    # categories = mongo.db.categories.find({}, {"CategoryID": 1, "CategoryName": 1})
     # category_dict = {}
     # for cat in categories:
     #     cat_id = cat['CategoryID']
@@ -56,31 +87,40 @@ def search():
     regex = {"$regex": '.*' + search_string + '.*', '$options': 'i'}
     results = mongo.db.products.find({"ProductName": regex}, {'_id': 0})
 
-    # Render a template for each product, then combine them into one long string
-    # and send to the user.
-    rendered_sections = []
-    for result in results:
-        category = category_dict[result['CategoryID']]
-        rendered_sections.append(render_template('product_key.html',
-                                                 product=result,
-                                                 category=category)) # Diff
+    # Render every product in one pass, each with its category name, and send
+    # to the user.
+    return jsonify(render_template('product_key_list.html',
+                                   products=results,
+                                   categories=category_dict)) # Diff
 
-    return jsonify("\n".join(rendered_sections))
+# How many documents /raw shows at once.
+RAW_PAGE_SIZE = 100
 
 @app.route('/raw/<collection>')
 @app.route('/raw')
 def raw(collection='orders'):
-    """A raw view of the entire contents of a collection."""
-
-    # Render a template for each document in the collection specified by the url.
-    data_arr = []
-    for result in mongo.db[collection].find({}, {"_id": 0}):
-        data_arr.append(render_template("generic_document.html", document=result))
-    raw_html = "\n".join(data_arr)
+    """A raw view of the contents of a collection, one page at a time. Pages
+    work the same way as raw() in app.py, with ?after=<_id>."""
+
+    query = {}
+    after = request.args.get('after')
+    if after:
+        if not ObjectId.is_valid(after):
+            abort(400)
+        query['_id'] = {'$gt': ObjectId(after)}
+    # Mongo reads a limit of 0 as no limit at all, so keep it to one page.
+    limit = min(max(request.args.get('limit', RAW_PAGE_SIZE, type=int), 1), RAW_PAGE_SIZE)
+    documents = list(mongo.db[collection].find(query).sort('_id', 1).limit(limit))
+
+    # Only link to another page if this one was full.
+    next_page = str(documents[-1]['_id']) if len(documents) == limit else None
+    for document in documents:
+        del document['_id']
 
     collections = mongo.db.collection_names()
 
-    return render_template("raw.html", data=raw_html, collections=collections)
+    return render_template("raw.html", documents=documents,
+                           collections=collections, next_page=next_page)
 
 @app.route('/order/<order_string>', methods=['GET', 'POST'])
 @app.route('/order', methods=['GET', 'POST'])
@@ -101,23 +141,23 @@ def order(order_string=""):
     if customer_data is None:
         return "Customer not found!"
 
-    # Find the largest order number and increment it to get the next order_number.
-    # NOTE: This does not guaruntee that the OrderID is unique, if another user runs
-    # this query before this route finishes.
-    order_num = next(mongo.db.orders.find().sort('OrderID', -1).limit(1)).get('OrderID') + 1
-
     products_requested = request.form.get('prod_id')
     # Convert the string into individual ints.
     product_data = list(map(int, products_requested.split(',')))
     if len(product_data) % 2:
         return "Invalid input. There should be even number of products and quanities."
 
-    # Build each of the product subdocuments, place them in a list
+    # Build each of the product subdocuments, place them in a list. The products
+    # are kept (with their category names from the reference cache) to build
+    # the order's view from.
+    categories = REFERENCE_CACHE.get('categories')
+    product_docs = {}
     products = []
     for i in range(len(product_data) // 2):
         product_id = product_data[2*i] # Grab every other element (to grab each product ID)
         quantity = product_data[2*i+1] # Grab every other element offset by 1 (to grab each quantity)
         product_doc = mongo.db.products.find_one({'ProductID': product_id})
+        product_docs[product_id] = order_view.product_fields(product_doc, categories)
         products.append({
             'ProductID': product_id,
             'UnitPrice': product_doc.get('UnitPrice'),
@@ -125,6 +165,10 @@ def order(order_string=""):
             'Discount': 0
         })
 
+    # The same OrderID counter app.py uses, so orders from either app (and
+    # from two users at once) never get the same ID. See counters.py.
+    order_num = counters.next_order_id(mongo.db)
+
     # Create the document that will be inserted into the database.
     order_dict = {
         'OrderID': order_num,
@@ -145,25 +189,28 @@ def order(order_string=""):
 
     # Insert into the databse.
     mongo.db.mongo_orders.insert(order_dict)
+    order_view.refresh_orders(mongo.db, [order_dict], product_docs)
     return redirect('/raw/mongo_orders')
 
 @app.route('/render_cart', methods=['POST'])
 def render_cart():
-    """Renders a template for each item in the cart, then returns them
-    concatonated together. Directly placed into page via JQuery."""
+    """Renders every item in the cart with a single template, then returns it.
+    Directly placed into page via JQuery."""
 
     # For some reason even though we specify "json" as the content type in
     # JavaScript, we still need to use 'force=True' to ignore headers and interpret as json.
     cart = request.get_json(force=True)
-    rendered = []
-    for cart_item in cart:
-        quantity = cart_item.get('quantity')
-        name = cart_item.get('name')
-        rendered.append(render_template('cart_item.html',
-                                        name=name,
-                                        quantity=quantity))
 
-    return jsonify("\n".join(rendered))
+    # cart_list.html renders every item in one pass.
+    return jsonify(render_template('cart_list.html', cart=cart))
+
+@app.before_first_request
+def init_order_counter():
+    counters.init_order_counter(mongo.db)
+
+@app.before_first_request
+def create_order_view_indexes():
+    order_view.create_indexes(mongo.db)
 
 @app.route('/expand_order/<order_id>')
 @app.route('/expand_order')
@@ -175,24 +222,14 @@ def expand_order(order_id=None):
     if order_id is None:
         return render_template("expand.html", order=None)
 
-    # Collect all the data from mongo.
-    order_data = mongo.db.mongo_orders.find_one({"OrderID": int(order_id)}, {"_id": 0})
-    print(order_data)
-    products = order_data.get('Products')
-
-    # We grab each of the ids for the products, then do a single mongo query for
-    # them, rather than doing a query for each id individualy.
-    id_dict = {product.get('ProductID'): product for product in products}
-    products_data = mongo.db.products.find({"ProductID": {"$in": list(id_dict)}}, {"_id": 0})
-
-    # Render templates for the order and products.
-    order_template = render_template("generic_document.html", document=order_data)
-    templates = []
-    for pd in products_data:
-        # Combine the two dictionaries
-        full_doc = {}
-        full_doc.update(pd)
-        full_doc.update(id_dict.get(pd.get('ProductID')))
-        templates.append(render_template("generic_document.html", document=full_doc))
-
-    return render_template("expand.html", order=order_template, products="\n".join(templates))
+    # Order views already have every product filled in, so this is one indexed
+    # read. Orders placed before the view existed get one written the first
+    # time they're looked at. See order_view.py.
+    order_data = mongo.db.order_views.find_one({"OrderID": int(order_id)}, {"_id": 0})
+    if order_data is None:
+        order_data = order_view.refresh_order(mongo.db, int(order_id))
+    if order_data is None:
+        return "Order not found!"
+
+    # Render the order and products in one pass.
+    return render_template("expand.html", order=order_data, products=order_data['Products'])
@@ -0,0 +1,266 @@
+"""
+    Async version of app.py. Serves the same routes with Quart (an asyncio
+    version of Flask) and Motor (an asyncio version of PyMongo), so a worker
+    isn't stuck waiting while a query is out on the network.
+
+    Run with: hypercorn async_app:app
+    Packages are in ../requirements-async.txt
+"""
+
+import asyncio
+import datetime
+import os
+import sys
+
+from bson.objectid import ObjectId
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument
+from pymongo.collation import Collation
+from quart import Quart, abort, render_template, request, jsonify, redirect, stream_template
+
+# cache.py is shared with the rest of the repo, and lives at the top of it.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+import order_view
+from cache import FragmentCache, LRUCache
+
+# Since I'm not a huge fan of putting passwords in plain code,
+# I've placed it in a environment variable saved under 'mongo_atlas_password'.
+# Set 'mongo_uri' instead to use another server (e.g. a local one for benchmarking).
+password = os.environ.get('mongo_atlas_password')
+username = 'najarvis'
+mongo_uri = os.environ.get('mongo_uri') or \
+            'mongodb+srv://' + username + ':' + str(password) + \
+            '@learningatlas01-1cf8c.gcp.mongodb.net/test?retryWrites=true'
+
+app = Quart(__name__)
+
+# Rendered html for single documents, shared by every request. Templates use it
+# through fragment(). See cache.FragmentCache.
+FRAGMENT_CACHE = FragmentCache(maxsize=4096)
+FRAGMENT_CACHE.install(app)
+
+client = AsyncIOMotorClient(mongo_uri)
+db = client.Northwind
+
+@app.route('/')
+async def index():
+    return redirect('/search')
+
+# See the search section of app.py, this works the same way.
+SEARCH_COLLATION = Collation(locale='en', strength=2)
+SEARCH_TTL = 30
+SEARCH_CACHE = LRUCache(maxsize=1024, ttl=SEARCH_TTL)
+
+@app.before_serving
+async def build_search_index():
+    """Creates the index search_products() uses. Also makes sure the OrderID
+    counter is up to date and the order views are indexed like
+    order_view.create_indexes() does."""
+    await db.products.create_index("ProductName", name="ProductName_search",
+                                   collation=SEARCH_COLLATION)
+    await db.order_views.create_index('OrderID', unique=True)
+    await db.order_views.create_index('Products.ProductID')
+    await db.order_views.create_index('Products.CategoryID')
+    await init_order_counter()
+
+def prefix_range(prefix):
+    """Same as prefix_range() in app.py."""
+    return {"$gte": prefix, "$lt": prefix + "\uffff"}
+
+async def search_products(search_string):
+    """Returns every product whose name starts with search_string, ignoring case."""
+    key = search_string.lower()
+    results = SEARCH_CACHE.get(key)
+    if results is None:
+        cursor = db.products.find({"ProductName": prefix_range(key)}, {'_id': 0},
+                                  collation=SEARCH_COLLATION)
+        results = await cursor.to_list(length=None)
+        SEARCH_CACHE.put(key, results)
+    return results
+
+@app.route('/search', methods=['GET', 'POST'])
+async def search():
+    """Search for and display products."""
+
+    if request.method == 'GET':
+        return await render_template("search.html")
+
+    # Execute the following code if it is a POST request.
+    form = await request.form
+    results = await search_products(form.get('data'))
+
+    # Render every product in one pass and send to the user.
+    return jsonify(await render_template('product_list.html', products=results))
+
+# How many documents /raw shows at once.
+RAW_PAGE_SIZE = 100
+
+@app.route('/raw/<collection>')
+@app.route('/raw')
+async def raw(collection='orders'):
+    """A raw view of the contents of a collection, one page at a time. Same as
+    raw() in app.py, including ?after=<_id> and ?stream=1"""
+
+    collections = await db.list_collection_names()
+
+    if request.args.get('stream'):
+        # Motor cursors can be looped over with 'async for', which the
+        # template does as the page is sent.
+        documents = db[collection].find({}, {"_id": 0})
+        return await stream_template("raw.html", documents=documents,
+                                     collections=collections, next_page=None)
+
+    query = {}
+    after = request.args.get('after')
+    if after:
+        if not ObjectId.is_valid(after):
+            abort(400)
+        query['_id'] = {'$gt': ObjectId(after)}
+    # Mongo reads a limit of 0 as no limit at all, so keep it to one page.
+    limit = min(max(request.args.get('limit', RAW_PAGE_SIZE, type=int), 1), RAW_PAGE_SIZE)
+    documents = await db[collection].find(query).sort('_id', 1).limit(limit).to_list(length=limit)
+
+    # Only link to another page if this one was full.
+    next_page = str(documents[-1]['_id']) if len(documents) == limit else None
+    for document in documents:
+        del document['_id']
+
+    return await render_template("raw.html", documents=documents,
+                                 collections=collections, next_page=next_page)
+
+async def init_order_counter():
+    """Same as counters.init_order_counter(), using Motor."""
+    largest = 0
+    for collection in (db.orders, db.mongo_orders):
+        async for doc in collection.find({}, {'OrderID': 1}).sort('OrderID', -1).limit(1):
+            largest = max(largest, doc.get('OrderID', 0))
+    await db.counters.update_one({'_id': 'OrderID'}, {'$max': {'seq': largest}}, upsert=True)
+
+async def next_order_id():
+    """Same as counters.next_order_id(), using Motor."""
+    counter = await db.counters.find_one_and_update({'_id': 'OrderID'},
+                                                    {'$inc': {'seq': 1}},
+                                                    upsert=True,
+                                                    return_document=ReturnDocument.AFTER)
+    return counter['seq']
+
+@app.route('/order/<order_string>', methods=['GET', 'POST'])
+@app.route('/order', methods=['GET', 'POST'])
+async def order(order_string=""):
+    """Insert data into the database through a form."""
+
+    if request.method == 'GET':
+        return await render_template('orders.html', order_string=order_string)
+
+    form = await request.form
+
+    # Parse date input
+    date = form.get('req_date')
+    # The date comes in the form 'YYYY-MM-DD', we need to convert it to ISO 8601 format
+    req_date = datetime.datetime.strptime(date, '%Y-%m-%d').isoformat()
+
+    products_requested = form.get('prod_id')
+    # Convert the string into individual ints.
+    product_data = list(map(int, products_requested.split(',')))
+    if len(product_data) % 2:
+        return "Invalid input. There should be even number of products and quanities."
+
+    # Every other element is a product ID, the ones in between are quantities.
+    line_items = list(zip(product_data[0::2], product_data[1::2]))
+    product_ids = list({product_id for product_id, _ in line_items})
+
+    # None of these depend on each other, so they all go out at once. If the
+    # order turns out to be invalid the OrderID is just skipped.
+    cust_id = form.get('cust_id')
+    customer_data, found, order_num = await asyncio.gather(
+        db.customers.find_one({'CustomerID': cust_id}),
+        db.products.aggregate(order_view.products_pipeline(product_ids)).to_list(length=None),
+        next_order_id())
+
+    if customer_data is None:
+        return "Customer not found!"
+
+    # With their category names, for the order's view.
+    product_docs = {doc['ProductID']: order_view.fields_from_pipeline(doc) for doc in found}
+    missing = [str(product_id) for product_id in product_ids if product_id not in product_docs]
+    if missing:
+        return "Products not found: " + ", ".join(missing)
+
+    # Build each of the product subdocuments, place them in a list
+    products = []
+    for product_id, quantity in line_items:
+        products.append({
+            'ProductID': product_id,
+            'UnitPrice': product_docs[product_id].get('UnitPrice'),
+            'Quantity': quantity,
+            'Discount': 0
+        })
+
+    # Create the document that will be inserted into the database.
+    order_dict = {
+        'OrderID': order_num,
+        'CustomerID': cust_id,
+        'EmployeeID': form.get('emp_id'),
+        'OrderDate': datetime.datetime.today().isoformat(),
+        'RequiredDate': req_date,
+        'ShipVia': 0, # Not quite sure what these two values are.
+        'Freight': 0,
+        'ShipName': customer_data.get('CompanyName'),
+        'ShipAddress': customer_data.get('Address'),
+        'ShipCity': customer_data.get('City'),
+        'ShipRegion': customer_data.get('Region'),
+        'ShipPostalCode': customer_data.get('PostalCode'),
+        'ShipCountry': customer_data.get('Country'),
+        'Products': products
+    }
+
+    # Insert into the databse.
+    await db.mongo_orders.insert_one(order_dict)
+    await write_order_view(order_dict, product_docs)
+    return redirect('/raw/mongo_orders')
+
+async def write_order_view(order, products=None):
+    """Same as order_view.refresh_orders() for a single order, using Motor."""
+    if products is None:
+        product_ids = [item.get('ProductID') for item in order.get('Products', [])]
+        pipeline = order_view.products_pipeline(product_ids)
+        products = {product['ProductID']: order_view.fields_from_pipeline(product)
+                    async for product in db.products.aggregate(pipeline)}
+    view = order_view.view_of(order, products)
+    await db.order_views.replace_one({'OrderID': view['OrderID']}, view, upsert=True)
+    return view
+
+@app.route('/render_cart', methods=['POST'])
+async def render_cart():
+    """Renders every item in the cart with a single template, then returns it.
+    Directly placed into page via JQuery."""
+
+    cart = await request.get_json(force=True)
+
+    # cart_list.html renders every item in one pass.
+    return jsonify(await render_template('cart_list.html', cart=cart))
+
+@app.route('/expand_order/<order_id>')
+@app.route('/expand_order')
+async def expand_order(order_id=None):
+    """Same as expand_order() in app.py."""
+
+    if order_id is None:
+        return await render_template("expand.html", order=None)
+
+    # One indexed read of the order view (see order_view.py), which has every
+    # product filled in already.
+    order_data = await db.order_views.find_one({"OrderID": int(order_id)}, {"_id": 0})
+    if order_data is not None:
+        return await render_template("expand.html", order=order_data,
+                                     products=order_data['Products'])
+
+    # Orders placed before the view existed get one written now.
+    order_data = await db.mongo_orders.find_one({"OrderID": int(order_id)})
+    if order_data is None:
+        return "Order not found!"
+    view = await write_order_view(order_data)
+
+    # Render the order and products in one pass.
+    return await render_template("expand.html", order=view, products=view['Products'])
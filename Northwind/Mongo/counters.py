@@ -0,0 +1,25 @@
+"""
+    OrderIDs for new orders. They come from a counter document in 'counters'
+    that is incremented atomically, so two orders placed at the same time can't
+    get the same ID, even from different apps (app.py and app_key.py both use
+    it) or different workers.
+"""
+
+from pymongo import ReturnDocument
+
+def init_order_counter(db):
+    """Makes sure the OrderID counter is at least the largest OrderID used so
+    far. $max means running this again (or from two servers) is harmless."""
+    largest = 0
+    for collection in (db.orders, db.mongo_orders):
+        for doc in collection.find({}, {'OrderID': 1}).sort('OrderID', -1).limit(1):
+            largest = max(largest, doc.get('OrderID', 0))
+    db.counters.update_one({'_id': 'OrderID'}, {'$max': {'seq': largest}}, upsert=True)
+
+def next_order_id(db):
+    """Returns a new, unique OrderID."""
+    counter = db.counters.find_one_and_update({'_id': 'OrderID'},
+                                              {'$inc': {'seq': 1}},
+                                              upsert=True,
+                                              return_document=ReturnDocument.AFTER)
+    return counter['seq']
@@ -0,0 +1,171 @@
+"""
+    A read model for showing orders. Each document in 'order_views' is an
+    order from mongo_orders with every product in it filled in, so expand_order
+    can show an order with one indexed find_one instead of fetching the order,
+    then its products, then merging them.
+
+    Views are written when an order is placed and patched when a product or
+    category changes (see refresh_product / refresh_category). Running this
+    file rebuilds every view, then keeps them up to date from change streams
+    on products and categories:
+        $ mongo_uri=mongodb://localhost:27017/Northwind python order_view.py
+"""
+
+import os
+import threading
+from itertools import islice
+
+from pymongo import MongoClient, ReplaceOne
+
+VIEWS = 'order_views'
+
+# Fields that come from the order-detail rather than the product. The price is
+# whatever it was when the order was placed, so these are never overwritten.
+DETAIL_FIELDS = ('ProductID', 'UnitPrice', 'Quantity', 'Discount')
+
+def create_indexes(db):
+    """OrderID is what expand_order looks views up by. Products.ProductID is
+    what the updaters look for when a product changes."""
+    db[VIEWS].create_index('OrderID', unique=True)
+    db[VIEWS].create_index('Products.ProductID')
+    db[VIEWS].create_index('Products.CategoryID')
+
+def load_categories(db, category_ids=None):
+    """CategoryID -> CategoryName for the given categories, or all of them."""
+    query = {} if category_ids is None else {'CategoryID': {'$in': list(category_ids)}}
+    return {category['CategoryID']: category['CategoryName']
+            for category in db.categories.find(query, {'_id': 0, 'CategoryID': 1, 'CategoryName': 1})}
+
+def product_fields(product, categories):
+    """The part of a product that gets copied into each order it is in."""
+    fields = {key: value for key, value in product.items() if key != '_id'}
+    fields['CategoryName'] = categories.get(product.get('CategoryID'))
+    return fields
+
+def load_products(db, product_ids=None, categories=None):
+    """ProductID -> product_fields() for the given products, or all of them.
+    Only the categories those products are in are read."""
+    query = {} if product_ids is None else {'ProductID': {'$in': list(product_ids)}}
+    products = list(db.products.find(query))
+    if categories is None:
+        categories = load_categories(db, {product.get('CategoryID') for product in products})
+    return {product['ProductID']: product_fields(product, categories)
+            for product in products}
+
+def products_pipeline(product_ids):
+    """Aggregation that fetches products along with their category, so the
+    fields for a view come back from a single query. See find_products()."""
+    return [
+        {'$match': {'ProductID': {'$in': list(product_ids)}}},
+        {'$lookup': {'from': 'categories', 'localField': 'CategoryID',
+                     'foreignField': 'CategoryID', 'as': 'category'}},
+    ]
+
+def fields_from_pipeline(product):
+    """product_fields() for a product from products_pipeline()."""
+    found = product.pop('category', [])
+    categories = {product.get('CategoryID'): found[0].get('CategoryName')} if found else {}
+    return product_fields(product, categories)
+
+def find_products(db, product_ids):
+    """ProductID -> product_fields() for the given products, from one query.
+    The result can be passed straight to refresh_orders()."""
+    return {product['ProductID']: fields_from_pipeline(product)
+            for product in db.products.aggregate(products_pipeline(product_ids))}
+
+def view_of(order, products):
+    """Builds the view for a mongo_orders document. Fields from the order's own
+    line items win over the product's."""
+    view = {key: value for key, value in order.items() if key != '_id'}
+    view['Products'] = [dict(products.get(item.get('ProductID'), {}), **item)
+                        for item in order.get('Products', [])]
+    return view
+
+def refresh_orders(db, orders, products=None):
+    """Writes (or rewrites) the views for some mongo_orders documents with a
+    single bulk write. Returns the views. If the products are already at hand
+    (ProductID -> product_fields(), like find_products() returns) pass them in
+    and nothing is read."""
+    orders = list(orders)
+    if not orders:
+        return []
+    if products is None:
+        product_ids = {item.get('ProductID') for order in orders for item in order.get('Products', [])}
+        products = find_products(db, product_ids)
+
+    views = [view_of(order, products) for order in orders]
+    db[VIEWS].bulk_write([ReplaceOne({'OrderID': view['OrderID']}, view, upsert=True)
+                          for view in views], ordered=False)
+    return views
+
+def refresh_order(db, order_id):
+    """Writes the view for one order. Returns it, or None if there's no such order."""
+    order = db.mongo_orders.find_one({'OrderID': order_id})
+    if order is None:
+        return None
+    return refresh_orders(db, [order])[0]
+
+def rebuild(db, batch_size=500):
+    """Rewrites every view from mongo_orders. Products are only read once."""
+    create_indexes(db)
+    products = load_products(db)
+    orders = db.mongo_orders.find()
+    written = 0
+    while True:
+        batch = list(islice(orders, batch_size))
+        if not batch:
+            break
+        written += len(refresh_orders(db, batch, products))
+    return written
+
+def refresh_product(db, product_id):
+    """Copies a product's current fields into every view that has it. Only
+    touches the matching line items. Returns the number of views changed."""
+    product = db.products.find_one({'ProductID': product_id})
+    if product is None:
+        return 0
+
+    fields = product_fields(product, load_categories(db, [product.get('CategoryID')]))
+    changes = {'Products.$[item].' + key: value for key, value in fields.items()
+               if key not in DETAIL_FIELDS}
+    result = db[VIEWS].update_many({'Products.ProductID': product_id},
+                                   {'$set': changes},
+                                   array_filters=[{'item.ProductID': product_id}])
+    return result.modified_count
+
+def refresh_category(db, category_id):
+    """Copies a category's name into every line item in that category."""
+    category = db.categories.find_one({'CategoryID': category_id})
+    name = category.get('CategoryName') if category else None
+    result = db[VIEWS].update_many({'Products.CategoryID': category_id},
+                                   {'$set': {'Products.$[item].CategoryName': name}},
+                                   array_filters=[{'item.CategoryID': category_id}])
+    return result.modified_count
+
+def watch_products(db):
+    """Calls refresh_product for every change to products, until interrupted.
+    Change streams need a replica set (Atlas clusters are one)."""
+    with db.products.watch(full_document='updateLookup') as stream:
+        for change in stream:
+            product = change.get('fullDocument')
+            if product is not None:
+                changed = refresh_product(db, product['ProductID'])
+                print("Product {} changed, updated {} orders".format(product['ProductID'], changed))
+
+def watch_categories(db):
+    """Calls refresh_category for every change to categories, until interrupted."""
+    with db.categories.watch(full_document='updateLookup') as stream:
+        for change in stream:
+            category = change.get('fullDocument')
+            if category is not None:
+                changed = refresh_category(db, category['CategoryID'])
+                print("Category {} changed, updated {} orders".format(category['CategoryID'], changed))
+
+if __name__ == "__main__":
+    client = MongoClient(os.environ.get('mongo_uri', 'mongodb://localhost:27017'))
+    db = client.Northwind
+    print("Rebuilt {} order views".format(rebuild(db)))
+    # One stream per collection, since the pinned pymongo can't watch a whole
+    # database. Categories are watched in the background.
+    threading.Thread(target=watch_categories, args=(db,), daemon=True).start()
+    watch_products(db)
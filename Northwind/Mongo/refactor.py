@@ -1,22 +1,82 @@
-from pymongo import MongoClient
+import os
+from itertools import islice
 
-client = MongoClient()
-db = client.Northwind
+from pymongo import MongoClient, ReplaceOne
+from pymongo.errors import OperationFailure
+
+import order_view
 
 # Orders and products in those orders are stored in two different collections,
-# this combines them into one.
-
-for order in db.orders.find():
-    order_id = order.get('OrderID')
-    products = []
-    for detail in db['order-details'].find({'OrderID': order_id}):
-        products.append({
-            'ProductID': detail.get('ProductID'),
-            'UnitPrice': detail.get('UnitPrice'),
-            'Quantity': detail.get('Quantity'),
-            'Discount': detail.get('Discount')
-        })
-
-    new_order = order.copy()
-    new_order.update({'Products': products})
-    db.mongo_orders.insert(new_order)
+# this combines them into one. Each order in mongo_orders gets a Products list
+# built from its order-details.
+#
+# The join happens on the server in one aggregation instead of one find per
+# order. It can be run again at any time: the aggregation only returns orders
+# that are new, or whose order-details no longer match their Products, and
+# only those are written. Orders placed through the app only live in
+# mongo_orders and are left alone.
+
+def create_indexes(db):
+    """Both $lookups and the writes match on OrderID, so it needs an index on each side."""
+    db['order-details'].create_index('OrderID')
+    db.orders.create_index('OrderID')
+    try:
+        db.mongo_orders.create_index('OrderID', unique=True)
+    except OperationFailure:
+        # Older versions of this script inserted every order again each run.
+        print("mongo_orders has duplicate OrderIDs. Drop it and run this again to rebuild it.")
+        raise
+
+def denormalize_pipeline():
+    """Aggregation stages that turn 'orders' into mongo_orders documents, leaving
+    out any that are already up to date."""
+    return [
+        {'$lookup': {'from': 'order-details', 'localField': 'OrderID',
+                     'foreignField': 'OrderID', 'as': 'details'}},
+        {'$addFields': {'Products': {'$map': {
+            'input': '$details',
+            'as': 'detail',
+            'in': {'ProductID': '$$detail.ProductID',
+                   'UnitPrice': '$$detail.UnitPrice',
+                   'Quantity': '$$detail.Quantity',
+                   'Discount': '$$detail.Discount'}}}}},
+        {'$project': {'details': 0}},
+
+        # Compare with what's already there. current.Products is a list holding
+        # the stored Products list, or an empty list if the order is missing.
+        {'$lookup': {'from': 'mongo_orders', 'localField': 'OrderID',
+                     'foreignField': 'OrderID', 'as': 'current'}},
+        {'$match': {'$expr': {'$eq': [{'$in': ['$Products', '$current.Products']}, False]}}},
+        {'$project': {'current': 0}},
+    ]
+
+def rebuild(db, batch_size=500):
+    """Brings mongo_orders up to date with orders and order-details. Returns
+    the OrderIDs that were written.
+
+    This is a single pass: the pipeline finds the orders that changed, and they
+    are written in batches as they stream back. ($merge could write them on
+    the server instead, but it can't say which orders it wrote, and the order
+    views need to know. Normally only a few orders have changed, so there isn't
+    much to send back.)"""
+    create_indexes(db)
+    order_ids = []
+    docs = db.orders.aggregate(denormalize_pipeline())
+    while True:
+        batch = list(islice(docs, batch_size))
+        if not batch:
+            break
+        db.mongo_orders.bulk_write([ReplaceOne({'OrderID': doc['OrderID']}, doc, upsert=True)
+                                    for doc in batch], ordered=False)
+        order_ids.extend(doc['OrderID'] for doc in batch)
+    return order_ids
+
+if __name__ == "__main__":
+    client = MongoClient(os.environ.get('mongo_uri', 'mongodb://localhost:27017'))
+    db = client.Northwind
+
+    order_ids = rebuild(db)
+    print("Rebuilt {} orders".format(len(order_ids)))
+
+    # Keep the order views (see order_view.py) in step with the orders that changed.
+    order_view.refresh_orders(db, db.mongo_orders.find({'OrderID': {'$in': order_ids}}))
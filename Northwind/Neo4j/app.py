@@ -7,15 +7,42 @@
 """
 
 import datetime
+import os
+import sys
 
-from flask import Flask, render_template, request, jsonify, redirect
-from py2neo import Graph, Node, Relationship
+from flask import Flask, Response, abort, render_template, request, jsonify, redirect, stream_with_context
 
-graph = Graph("bolt://54.86.9.156:33227",
-              auth=("neo4j", "trace-refurbishment-currency"))
+# cache.py and connections.py are shared with the rest of the repo, and live at
+# the top of it.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from cache import FragmentCache
+from connections import neo4j_graph, pool_stats
+from queries import Queries, UnknownLabel, parse_cursor
+
+# Set 'neo4j_uri' (and 'neo4j_user' / 'neo4j_password') to use another server,
+# e.g. a local one for benchmarking. Nothing connects until the first request;
+# 'pool_size' / 'pool_timeout' limit how many requests use it at once.
+graph = neo4j_graph("northwind",
+                    os.environ.get('neo4j_uri', "bolt://54.86.9.156:33227"),
+                    auth=(os.environ.get('neo4j_user', "neo4j"),
+                          os.environ.get('neo4j_password', "trace-refurbishment-currency")))
+
+# Every query that takes user input goes through here. See queries.py.
+queries = Queries(graph)
 
 app = Flask(__name__)
 
+# Rendered html for single documents, shared by every request. Templates use it
+# through fragment(). See cache.FragmentCache.
+FRAGMENT_CACHE = FragmentCache(maxsize=4096)
+FRAGMENT_CACHE.install(app)
+
+@app.route('/metrics')
+def metrics():
+    """How busy the database connection pool is."""
+    return jsonify(pool_stats())
+
 @app.route('/')
 def index():
     return redirect('/search')
@@ -28,47 +55,88 @@ def search():
         return render_template("search.html")
 
     # Execute the following code if it is a POST request.
-    search_string = request.form.get('data')
-    # Regex to match anything before and after the search string, case insensitive.
-    # If the search string was 'cho', it would match 'Chocolate' and 'Ochocinco'
-    query = """
-        MATCH (p:Product)
-        WHERE p.ProductName =~ '(?i).*{}.*'
-        RETURN p
-    """.format(search_string)
-    results = graph.run(query)
-
-    # Render a template for each product, then combine them into one long string
-    # and send to the user.
-    rendered_sections = []
-    for result in results:
-        # result comes back as an array of results, so we only want to grab the first one.
-        # we would want to grab multiple if we were to return multiple things
-        # (i.e. and product and an order)
-        rendered_sections.append(render_template('product.html', product=result[0]))
+    # The search string is passed as a parameter, so it's never run as Cypher.
+    products = queries.search_products(request.form.get('data'))
+
+    # Render every product in one pass and send to the user. Products shown in
+    # the last minute reuse their cached html.
+    return jsonify(render_template('product_list.html', products=products))
+
+# How many nodes /raw shows at once.
+RAW_PAGE_SIZE = 100
 
-    return jsonify("\n".join(rendered_sections))
+def stream_template(template_name, **context):
+    """Like render_template, but sends the page to the client bit by bit as it
+    is rendered instead of building the whole thing in memory first. Any
+    generators passed in are only read as the page is sent."""
+    app.update_template_context(context)
+    template = app.jinja_env.get_template(template_name)
+    return Response(stream_with_context(template.generate(context)))
 
 @app.route('/raw/<collection>')
 @app.route('/raw')
 def raw(collection='Order'):
-    """A raw view of the entire contents of a collection."""
-
-    # Render a template for each document in the collection specified by the url.
-    data_arr = []
-    query = """
-        MATCH (n:{collection})
-        RETURN n
-    """.format(collection=collection)
-    for result in graph.run(query):
-        data_arr.append(render_template("generic_document.html", document=result[0]))
-    raw_html = "\n".join(data_arr)
-
-    # return each distinct first label of a node. here Graph.evaluate returns the first result.
-    # Because we are using 'collect', there is only one result.
-    collections = graph.evaluate("MATCH (n) RETURN collect(distinct labels(n)[0]);")
-
-    return render_template("raw.html", data=raw_html, collections=collections)
+    """A raw view of the contents of a label, one page at a time.
+
+    Nodes are shown in order of the label's key, and pages are found with the
+    key of the last node on the previous page (?after=<key>) rather than using
+    SKIP. Each page is a seek on the key's index, so the last page is as quick
+    as the first. See queries.PAGE_KEYS. Add ?stream=1 to stream every node
+    instead."""
+
+    # Anything that isn't an existing label is a 404, rather than becoming part
+    # of a query.
+    try:
+        collection = queries.check_label(collection)
+    except UnknownLabel:
+        abort(404)
+    collections = queries.labels()
+
+    if request.args.get('stream'):
+        # The cursor is only read as the page is sent.
+        documents = queries.label_nodes(collection)
+        return stream_template("raw.html", documents=documents,
+                               collections=collections, next_page=None)
+
+    after = None
+    if request.args.get('after'):
+        try:
+            after = parse_cursor(collection, request.args['after'])
+        except ValueError:
+            abort(400)
+    # At most one page, however big a limit is asked for.
+    limit = min(max(request.args.get('limit', RAW_PAGE_SIZE, type=int), 1), RAW_PAGE_SIZE)
+    documents, cursor = queries.label_page(collection, after=after, limit=limit)
+
+    # Only link to another page if this one was full.
+    next_page = cursor if len(documents) == limit else None
+
+    return render_template("raw.html", documents=documents,
+                           collections=collections, next_page=next_page)
+
+# (label, property) pairs that are looked up when placing an order.
+ORDER_SCHEMA = [('Product', 'ProductID'),
+                ('Customer', 'CustomerID'),
+                ('Order', 'OrderID'),
+                ('Sequence', 'name')]
+
+@app.before_first_request
+def create_order_schema():
+    """Creates the constraints order placement relies on, and the node OrderIDs
+    are taken from. The sequence starts at the largest OrderID so far, which is
+    the only time every order has to be looked at."""
+    # These are the same uniqueness constraints load_data.py creates (each one
+    # comes with an index). Neo4j won't add a plain index on top of one, and 4.x
+    # raises an error for creating one that exists, so existing ones are skipped.
+    for label, key in ORDER_SCHEMA:
+        if (key,) not in graph.schema.get_indexes(label):
+            graph.run("CREATE CONSTRAINT ON (n:{}) ASSERT n.{} IS UNIQUE;".format(label, key))
+    graph.run("""
+        OPTIONAL MATCH (o:Order)
+        WITH max(toInteger(o.OrderID)) AS largest
+        MERGE (seq:Sequence {name: 'OrderID'})
+        ON CREATE SET seq.value = coalesce(largest, 0);
+    """)
 
 @app.route('/order/<order_string>', methods=['GET', 'POST'])
 @app.route('/order', methods=['GET', 'POST'])
@@ -89,36 +157,18 @@ def order(order_string=""):
     if customer_data is None:
         return "Customer not found!"
 
-    # Find the largest order number and increment it to get the next order_number.
-    # NOTE: This does not guaruntee that the OrderID is unique, if another user runs
-    # this query before this route finishes.
-    order_num = int(graph.evaluate("MATCH (o:Order) RETURN max(o.OrderID);")) + 1
-    order_num = str(order_num)
-    print(order_num)
-
     products_requested = request.form.get('prod_id')
     # Convert the string into individual ints.
-    product_data = products_requested.split(',')
+    product_data = list(map(int, products_requested.split(',')))
     if len(product_data) % 2:
         return "Invalid input. There should be even number of products and quantities."
 
-    # Build each of the product subdocuments, place them in a list
-    products = []
-    for i in range(len(product_data) // 2):
-        product_id = product_data[2*i]
-        quantity = product_data[2*i+1]
-        product_doc = graph.nodes.match("Product", ProductID=product_id).first()
-        products.append({
-            'ProductID': product_id,
-            'UnitPrice': product_doc.get('UnitPrice'),
-            'Quantity': quantity,
-            'Discount': 0,
-            'OrderID': order_num
-        })
-
-    # Create the document that will be inserted into the database.
+    # Every other element is a product ID, the ones in between are quantities.
+    items = [{'ProductID': product_id, 'Quantity': quantity}
+             for product_id, quantity in zip(product_data[0::2], product_data[1::2])]
+
+    # Create the properties that will be put on the order node.
     order_dict = {
-        'OrderID': order_num,
         'CustomerID': cust_id,
         'EmployeeID': request.form.get('emp_id'),
         'OrderDate': datetime.datetime.today().isoformat(),
@@ -133,48 +183,51 @@ def order(order_string=""):
         'ShipCountry': customer_data.get('Country')
     }
 
-    # This is an example transaction. Transactions are ACID compliant.
-    tx = graph.begin()
-
-    # Create a node based on the dictionary above
-    order_node = Node("Order", **order_dict)
-    tx.create(order_node)
-
-    # Create a node for each product with the order-detail label.
-    for product in products:
-        product_id = product.get('ProductID')
-        order_detail_node = Node("Order-Detail", **product)
-        tx.create(order_detail_node)
-
-        # Match that node to the actual product node
-        product_node = graph.run("MATCH (p:Product {ProductID: {pid}}) RETURN p",
-                                 pid=product_id).evaluate()
-
-        # Create relationships.
-        tx.create(Relationship(order_detail_node, "PART_OF", order_node))
-        tx.create(Relationship(order_detail_node, "IS", product_node))
-    tx.commit()
+    # The whole order is placed by this one statement, so it either all happens
+    # or none of it does. First every product is looked up (using the ProductID
+    # index). If any are missing the WHERE filters everything out and nothing
+    # is created. Otherwise the OrderID sequence is incremented (SET locks the
+    # node, so two orders can't get the same number), and the order and an
+    # order-detail node for each item are created.
+    query = """
+        UNWIND $items AS item
+        OPTIONAL MATCH (p:Product {ProductID: item.ProductID})
+        WITH collect({item: item, product: p}) AS rows, count(p) AS found
+        WHERE found = size($items)
+        MATCH (seq:Sequence {name: 'OrderID'})
+        SET seq.value = seq.value + 1
+        CREATE (o:Order)
+        SET o += $order, o.OrderID = seq.value
+        WITH o, rows
+        UNWIND rows AS row
+        WITH o, row.item AS item, row.product AS p
+        CREATE (od:`Order-Detail` {ProductID: item.ProductID,
+                                   UnitPrice: p.UnitPrice,
+                                   Quantity: item.Quantity,
+                                   Discount: 0,
+                                   OrderID: o.OrderID})
+        CREATE (od)-[:PART_OF]->(o)
+        CREATE (od)-[:IS]->(p)
+        RETURN DISTINCT o.OrderID;
+    """
+    order_num = graph.evaluate(query, items=items, order=order_dict)
+    if order_num is None:
+        return "One or more products not found!"
 
     # Insert into the databse.
-    return redirect('/expand_order/' + order_num)
+    return redirect('/expand_order/' + str(order_num))
 
 @app.route('/render_cart', methods=['POST'])
 def render_cart():
-    """Renders a template for each item in the cart, then returns them
-    concatonated together. Directly placed into page via JQuery."""
+    """Renders every item in the cart with a single template, then returns it.
+    Directly placed into page via JQuery."""
 
     # For some reason even though we specify "json" as the content type in
     # JavaScript, we still need to use 'force=True' to ignore headers and interpret as json.
     cart = request.get_json(force=True)
-    rendered = []
-    for cart_item in cart:
-        quantity = cart_item.get('quantity')
-        name = cart_item.get('name')
-        rendered.append(render_template('cart_item.html',
-                                        name=name,
-                                        quantity=quantity))
 
-    return jsonify("\n".join(rendered))
+    # cart_list.html renders every item in one pass.
+    return jsonify(render_template('cart_list.html', cart=cart))
 
 @app.route('/expand_order/<order_id>')
 @app.route('/expand_order')
@@ -187,21 +240,21 @@ def expand_order(order_id=None):
         return render_template("expand.html", order=None)
 
     # We grab the inital order node
-    order_data = graph.nodes.match("Order", OrderID=order_id).first()
+    order_data = graph.nodes.match("Order", OrderID=int(order_id)).first()
     # Then grab all order-detail nodes and product nodes related to it.
     query = """
-        MATCH (od:`Order-Detail` {OrderID: {o_id}})-[:IS]->(p)
+        MATCH (od:`Order-Detail` {OrderID: $o_id})-[:IS]->(p)
         RETURN p, od;
     """
-    results = graph.run(query, o_id=order_id)
+    results = graph.run(query, o_id=int(order_id))
 
-    order_temp = render_template("generic_document.html", document=dict(order_data))
-    templates = []
+    full_docs = []
     for result in results:
-        # Combine both the product node and order-detail node into one, then display it.
+        # Combine both the product node and order-detail node into one.
         full_doc = {}
         full_doc.update(result['p'])
         full_doc.update(result['od'])
-        templates.append(render_template("generic_document.html", document=dict(full_doc)))
+        full_docs.append(full_doc)
 
-    return render_template("expand.html", order=order_temp, products="\n".join(templates))
+    # Render the order and products in one pass.
+    return render_template("expand.html", order=dict(order_data), products=full_docs)
@@ -7,15 +7,58 @@
 """
 
 import datetime
+import os
+import sys
 
-from flask import Flask, render_template, request, jsonify, redirect
-from py2neo import Graph, Node, Relationship
+from flask import Flask, abort, render_template, request, jsonify, redirect
+from py2neo import Node, Relationship
 
-graph = Graph("bolt://18.207.142.251:34366",
-              auth=("neo4j", "capitals-photodiode-winter"))
+# cache.py and connections.py are shared with the rest of the repo, and live at
+# the top of it.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from cache import ReferenceCache
+from connections import neo4j_graph
+from queries import Queries, UnknownLabel, parse_cursor
+
+# Nothing connects until the first request. See connections.py.
+graph = neo4j_graph("northwind_key", "bolt://18.207.142.251:34366",
+                    auth=("neo4j", "capitals-photodiode-winter"))
+
+# Every query that takes user input goes through here. See queries.py.
+queries = Queries(graph)
 
 app = Flask(__name__)
 
+# Lookup tables for reference data that almost never changes. Each maps an ID
+# to a name. They're loaded the first time they're needed, then kept for every
+# request until they expire or the number of nodes changes.
+REFERENCE_CACHE = ReferenceCache(ttl=600, check_interval=30)
+
+def register_reference_table(label, id_field, name_field):
+    def load():
+        query = """
+            MATCH (n:{label})
+            RETURN n.{id_field} AS id, n.{name_field} AS name
+        """.format(label=label, id_field=id_field, name_field=name_field)
+        return {record['id']: record['name'] for record in graph.run(query)}
+
+    def version():
+        # Counting a label comes straight from the count store, so it's cheap.
+        return graph.evaluate("MATCH (n:{}) RETURN count(n)".format(label))
+
+    REFERENCE_CACHE.register(label, load, version)
+
+register_reference_table('Category', 'CategoryID', 'CategoryName')
+register_reference_table('Supplier', 'SupplierID', 'CompanyName')
+register_reference_table('Shipper', 'ShipperID', 'CompanyName')
+register_reference_table('Region', 'RegionID', 'RegionDescription')
+
+@app.route('/metrics')
+def metrics():
+    """Hit rate and size of the reference data cache."""
+    return jsonify(REFERENCE_CACHE.stats())
+
 @app.route('/')
 def index():
     return redirect('/search')
@@ -28,46 +71,47 @@ def search():
         return render_template("search.html")
 
     # Execute the following code if it is a POST request.
-    search_string = request.form.get('data')
-    # Regex to match anything before and after the search string, case insensitive.
-    # If the search string was 'cho', it would match 'Chocolate' and 'Ochocinco'
-    query = """
-        MATCH (p:Product)-[:IS_CATEGORY]->(c)
-        WHERE p.ProductName =~ '(?i).*{}.*'
-        RETURN p, c.CategoryName
-    """.format(search_string)
-    results = graph.run(query)
-
-    # Render a template for each product, then combine them into one long string
-    # and send to the user.
-    rendered_sections = []
-    for result in results:
-        # result comes back as an array of results, so we weamt to grab both the product
-        # (the first element) and the category name (the second element).
-        rendered_sections.append(render_template('product_key.html', product=result[0], category=result[1]))
+    # The category name comes from the reference cache using the product's
+    # CategoryID, rather than following IS_CATEGORY for every product.
+    products = queries.search_products(request.form.get('data'))
+    category_dict = REFERENCE_CACHE.get('Category')
+
+    # Render every product in one pass, each with its category name, and send
+    # to the user.
+    return jsonify(render_template('product_key_list.html', products=products, categories=category_dict))
 
-    return jsonify("\n".join(rendered_sections))
+# How many nodes /raw shows at once.
+RAW_PAGE_SIZE = 100
 
 @app.route('/raw/<collection>')
 @app.route('/raw')
 def raw(collection='Order'):
-    """A raw view of the entire contents of a collection."""
-
-    # Render a template for each document in the collection specified by the url.
-    data_arr = []
-    query = """
-        MATCH (n:{collection})
-        RETURN n
-    """.format(collection=collection)
-    for result in graph.run(query):
-        data_arr.append(render_template("generic_document.html", document=result[0]))
-    raw_html = "\n".join(data_arr)
-
-    # return each distinct first label of a node. here Graph.evaluate returns the first result.
-    # Because we are using 'collect', there is only one result.
-    collections = graph.evaluate("MATCH (n) RETURN collect(distinct labels(n)[0]);")
-
-    return render_template("raw.html", data=raw_html, collections=collections)
+    """A raw view of the contents of a label, one page at a time. Pages work
+    the same way as raw() in app.py, with ?after=<key>."""
+
+    # raw.html renders each node with the label specified by the url. Anything
+    # that isn't an existing label is a 404. See queries.py.
+    try:
+        collection = queries.check_label(collection)
+    except UnknownLabel:
+        abort(404)
+    collections = queries.labels()
+
+    after = None
+    if request.args.get('after'):
+        try:
+            after = parse_cursor(collection, request.args['after'])
+        except ValueError:
+            abort(400)
+    # At most one page, however big a limit is asked for.
+    limit = min(max(request.args.get('limit', RAW_PAGE_SIZE, type=int), 1), RAW_PAGE_SIZE)
+    documents, cursor = queries.label_page(collection, after=after, limit=limit)
+
+    # Only link to another page if this one was full.
+    next_page = cursor if len(documents) == limit else None
+
+    return render_template("raw.html", documents=documents,
+                           collections=collections, next_page=next_page)
 
 @app.route('/order/<order_string>', methods=['GET', 'POST'])
 @app.route('/order', methods=['GET', 'POST'])
@@ -92,12 +136,11 @@ def order(order_string=""):
     # NOTE: This does not guaruntee that the OrderID is unique, if another user runs
     # this query before this route finishes.
     order_num = int(graph.evaluate("MATCH (o:Order) RETURN max(o.OrderID);")) + 1
-    order_num = str(order_num)
     print(order_num)
 
     products_requested = request.form.get('prod_id')
     # Convert the string into individual ints.
-    product_data = products_requested.split(',')
+    product_data = list(map(int, products_requested.split(',')))
     if len(product_data) % 2:
         return "Invalid input. There should be even number of products and quantities."
 
@@ -146,7 +189,7 @@ def order(order_string=""):
         tx.create(order_detail_node)
 
         # Match that node to the actual product node
-        product_node = graph.run("MATCH (p:Product {ProductID: {pid}}) RETURN p",
+        product_node = graph.run("MATCH (p:Product {ProductID: $pid}) RETURN p",
                                  pid=product_id).evaluate()
 
         # Create relationships.
@@ -155,25 +198,19 @@ def order(order_string=""):
     tx.commit()
 
     # Insert into the databse.
-    return redirect('/expand_order/' + order_num)
+    return redirect('/expand_order/' + str(order_num))
 
 @app.route('/render_cart', methods=['POST'])
 def render_cart():
-    """Renders a template for each item in the cart, then returns them
-    concatonated together. Directly placed into page via JQuery."""
+    """Renders every item in the cart with a single template, then returns it.
+    Directly placed into page via JQuery."""
 
     # For some reason even though we specify "json" as the content type in
     # JavaScript, we still need to use 'force=True' to ignore headers and interpret as json.
     cart = request.get_json(force=True)
-    rendered = []
-    for cart_item in cart:
-        quantity = cart_item.get('quantity')
-        name = cart_item.get('name')
-        rendered.append(render_template('cart_item.html',
-                                        name=name,
-                                        quantity=quantity))
 
-    return jsonify("\n".join(rendered))
+    # cart_list.html renders every item in one pass.
+    return jsonify(render_template('cart_list.html', cart=cart))
 
 @app.route('/expand_order/<order_id>')
 @app.route('/expand_order')
@@ -186,21 +223,21 @@ def expand_order(order_id=None):
         return render_template("expand.html", order=None)
 
     # We grab the inital order node
-    order_data = graph.nodes.match("Order", OrderID=order_id).first()
+    order_data = graph.nodes.match("Order", OrderID=int(order_id)).first()
     # Then grab all order-detail nodes and product nodes related to it.
     query = """
-        MATCH (od:`Order-Detail` {OrderID: {o_id}})-[:IS]->(p)
+        MATCH (od:`Order-Detail` {OrderID: $o_id})-[:IS]->(p)
         RETURN p, od;
     """
-    results = graph.run(query, o_id=order_id)
+    results = graph.run(query, o_id=int(order_id))
 
-    order_temp = render_template("generic_document.html", document=dict(order_data))
-    templates = []
+    full_docs = []
     for result in results:
-        # Combine both the product node and order-detail node into one, then display it.
+        # Combine both the product node and order-detail node into one.
         full_doc = {}
         full_doc.update(result['p'])
         full_doc.update(result['od'])
-        templates.append(render_template("generic_document.html", document=dict(full_doc)))
+        full_docs.append(full_doc)
 
-    return render_template("expand.html", order=order_temp, products="\n".join(templates))
+    # Render the order and products in one pass.
+    return render_template("expand.html", order=dict(order_data), products=full_docs)
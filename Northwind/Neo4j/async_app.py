@@ -0,0 +1,288 @@
+"""
+    Async version of app.py. Serves the same routes with Quart (an asyncio
+    version of Flask) and the official neo4j driver's asyncio API, so a worker
+    isn't stuck waiting while a query is out on the network.
+
+    The async driver needs Neo4j 4.4 or newer. See ../benchmark.py for a
+    setup that runs this and app.py against the same server.
+
+    Run with: hypercorn async_app:app
+    Packages are in ../requirements-async.txt
+"""
+
+import asyncio
+import datetime
+import os
+import sys
+
+from neo4j import AsyncGraphDatabase
+from quart import Quart, abort, render_template, request, jsonify, redirect, stream_template
+
+# cache.py is shared with the rest of the repo, and lives at the top of it.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from cache import FragmentCache
+from queries import (PAGE_KEYS, first_key, format_cursor, last_key, page_params, page_query,
+                     parse_cursor, quote_label, strip_label)
+
+# Set 'neo4j_uri' (and 'neo4j_user' / 'neo4j_password') to use another server,
+# e.g. a local one for benchmarking.
+driver = AsyncGraphDatabase.driver(
+    os.environ.get('neo4j_uri', "bolt://54.86.9.156:33227"),
+    auth=(os.environ.get('neo4j_user', "neo4j"),
+          os.environ.get('neo4j_password', "trace-refurbishment-currency")))
+
+app = Quart(__name__)
+
+# Rendered html for single documents, shared by every request. Templates use it
+# through fragment(). See cache.FragmentCache.
+FRAGMENT_CACHE = FragmentCache(maxsize=4096)
+FRAGMENT_CACHE.install(app)
+
+async def run(query, **params):
+    """Runs a query in its own session and returns every record."""
+    async with driver.session() as session:
+        result = await session.run(query, params)
+        return [record async for record in result]
+
+async def evaluate(query, **params):
+    """Like Graph.evaluate in py2neo: returns the first value of the first
+    record, or None if there weren't any."""
+    async with driver.session() as session:
+        result = await session.run(query, params)
+        record = await result.single()
+        return None if record is None else record[0]
+
+async def stream_nodes(query, **params):
+    """Yields the first value of each record as a dict. The session stays open
+    until the last record is read, so this can be handed straight to a
+    streamed template."""
+    async with driver.session() as session:
+        result = await session.run(query, params)
+        async for record in result:
+            yield dict(record[0])
+
+@app.after_serving
+async def close_driver():
+    await driver.close()
+
+@app.route('/')
+async def index():
+    return redirect('/search')
+
+@app.route('/search', methods=['GET', 'POST'])
+async def search():
+    """Search for and display products."""
+
+    if request.method == 'GET':
+        return await render_template("search.html")
+
+    # Execute the following code if it is a POST request.
+    form = await request.form
+    # Case insensitive match of anything containing the search string.
+    query = """
+        MATCH (p:Product)
+        WHERE toLower(p.ProductName) CONTAINS toLower($search)
+        RETURN p
+    """
+    results = await run(query, search=form.get('data'))
+    products = [dict(result[0]) for result in results]
+
+    # Render every product in one pass and send to the user.
+    return jsonify(await render_template('product_list.html', products=products))
+
+# How many nodes /raw shows at once.
+RAW_PAGE_SIZE = 100
+
+@app.route('/raw/<collection>')
+@app.route('/raw')
+async def raw(collection='Order'):
+    """A raw view of the contents of a label, one page at a time. Same as
+    raw() in app.py, including ?after=<key> and ?stream=1"""
+
+    # Labels can't be parameters, so only ones that exist are put in the query.
+    # See queries.py.
+    collections = sorted(await evaluate("CALL db.labels() YIELD label RETURN collect(label);"))
+    collection = strip_label(collection)
+    if collection not in collections:
+        abort(404)
+
+    if request.args.get('stream'):
+        query = """
+            MATCH (n:{collection})
+            RETURN n
+        """.format(collection=quote_label(collection))
+        return await stream_template("raw.html", documents=stream_nodes(query),
+                                     collections=collections, next_page=None)
+
+    after = first_key(collection)
+    if request.args.get('after'):
+        try:
+            after = parse_cursor(collection, request.args['after'])
+        except ValueError:
+            abort(400)
+    # At most one page, however big a limit is asked for.
+    limit = min(max(request.args.get('limit', RAW_PAGE_SIZE, type=int), 1), RAW_PAGE_SIZE)
+    params = page_params(after) if after is not None else {}
+    results = await run(page_query(collection), limit=limit, **params)
+    documents = [dict(result['n']) for result in results]
+
+    # Only link to another page if this one was full, and the label has a key
+    # to page on.
+    next_page = None
+    if len(documents) == limit and collection in PAGE_KEYS:
+        next_page = format_cursor(last_key(collection, documents[-1]))
+
+    return await render_template("raw.html", documents=documents,
+                                 collections=collections, next_page=next_page)
+
+# Same as ORDER_SCHEMA in app.py.
+ORDER_SCHEMA = [('Product', 'ProductID'),
+                ('Customer', 'CustomerID'),
+                ('Order', 'OrderID'),
+                ('Sequence', 'name')]
+
+@app.before_serving
+async def create_order_schema():
+    """Same as create_order_schema() in app.py, in Neo4j 4.4+ syntax."""
+    # IF NOT EXISTS only matches the same constraint, so ones with an index on
+    # them already (from load_data.py or an older version of this) are skipped.
+    indexed = {(labels[0], properties[0]) for labels, properties in await run(
+        "SHOW INDEXES YIELD labelsOrTypes, properties WHERE size(properties) = 1 "
+        "RETURN labelsOrTypes, properties;")}
+    for label, key in ORDER_SCHEMA:
+        if (label, key) not in indexed:
+            await run("CREATE CONSTRAINT IF NOT EXISTS FOR (n:{}) REQUIRE n.{} IS UNIQUE;".format(
+                label, key))
+    await run("""
+        OPTIONAL MATCH (o:Order)
+        WITH max(toInteger(o.OrderID)) AS largest
+        MERGE (seq:Sequence {name: 'OrderID'})
+        ON CREATE SET seq.value = coalesce(largest, 0);
+    """)
+
+@app.route('/order/<order_string>', methods=['GET', 'POST'])
+@app.route('/order', methods=['GET', 'POST'])
+async def order(order_string=""):
+    """Insert data into the database through a form."""
+
+    if request.method == 'GET':
+        return await render_template('orders.html', order_string=order_string)
+
+    form = await request.form
+
+    # Parse date input
+    date = form.get('req_date')
+    # The date comes in the form 'YYYY-MM-DD', we need to convert it to ISO 8601 format
+    req_date = datetime.datetime.strptime(date, '%Y-%m-%d').isoformat()
+
+    products_requested = form.get('prod_id')
+    # Convert the string into individual ints.
+    product_data = list(map(int, products_requested.split(',')))
+    if len(product_data) % 2:
+        return "Invalid input. There should be even number of products and quantities."
+
+    # Every other element is a product ID, the ones in between are quantities.
+    items = [{'ProductID': product_id, 'Quantity': quantity}
+             for product_id, quantity in zip(product_data[0::2], product_data[1::2])]
+    product_ids = list({item['ProductID'] for item in items})
+
+    # The customer and the products don't depend on each other, so both
+    # lookups go out at once.
+    cust_id = form.get('cust_id')
+    customer_data, found = await asyncio.gather(
+        evaluate("MATCH (c:Customer {CustomerID: $cust_id}) RETURN c", cust_id=cust_id),
+        evaluate("""
+            MATCH (p:Product) WHERE p.ProductID IN $product_ids
+            RETURN collect(p.ProductID)
+        """, product_ids=product_ids))
+
+    if customer_data is None:
+        return "Customer not found!"
+
+    missing = [str(product_id) for product_id in product_ids if product_id not in found]
+    if missing:
+        return "Products not found: " + ", ".join(missing)
+
+    # Create the properties that will be put on the order node.
+    order_dict = {
+        'CustomerID': cust_id,
+        'EmployeeID': form.get('emp_id'),
+        'OrderDate': datetime.datetime.today().isoformat(),
+        'RequiredDate': req_date,
+        'ShipVia': 0, # Not quite sure what these two values are.
+        'Freight': 0,
+        'ShipName': customer_data.get('CompanyName'),
+        'ShipAddress': customer_data.get('Address'),
+        'ShipCity': customer_data.get('City'),
+        'ShipRegion': customer_data.get('Region'),
+        'ShipPostalCode': customer_data.get('PostalCode'),
+        'ShipCountry': customer_data.get('Country')
+    }
+
+    # Same single statement as order() in app.py. It still checks the products
+    # itself, in case one was deleted since the lookup above.
+    query = """
+        UNWIND $items AS item
+        OPTIONAL MATCH (p:Product {ProductID: item.ProductID})
+        WITH collect({item: item, product: p}) AS rows, count(p) AS found
+        WHERE found = size($items)
+        MATCH (seq:Sequence {name: 'OrderID'})
+        SET seq.value = seq.value + 1
+        CREATE (o:Order)
+        SET o += $order, o.OrderID = seq.value
+        WITH o, rows
+        UNWIND rows AS row
+        WITH o, row.item AS item, row.product AS p
+        CREATE (od:`Order-Detail` {ProductID: item.ProductID,
+                                   UnitPrice: p.UnitPrice,
+                                   Quantity: item.Quantity,
+                                   Discount: 0,
+                                   OrderID: o.OrderID})
+        CREATE (od)-[:PART_OF]->(o)
+        CREATE (od)-[:IS]->(p)
+        RETURN DISTINCT o.OrderID;
+    """
+    order_num = await evaluate(query, items=items, order=order_dict)
+    if order_num is None:
+        return "One or more products not found!"
+
+    return redirect('/expand_order/' + str(order_num))
+
+@app.route('/render_cart', methods=['POST'])
+async def render_cart():
+    """Renders every item in the cart with a single template, then returns it.
+    Directly placed into page via JQuery."""
+
+    cart = await request.get_json(force=True)
+
+    # cart_list.html renders every item in one pass.
+    return jsonify(await render_template('cart_list.html', cart=cart))
+
+@app.route('/expand_order/<order_id>')
+@app.route('/expand_order')
+async def expand_order(order_id=None):
+    """Same as expand_order() in app.py."""
+
+    if order_id is None:
+        return await render_template("expand.html", order=None)
+
+    # The order node and its order-detail / product nodes are fetched at the same time.
+    query = """
+        MATCH (od:`Order-Detail` {OrderID: $o_id})-[:IS]->(p)
+        RETURN p, od;
+    """
+    order_data, results = await asyncio.gather(
+        evaluate("MATCH (o:Order {OrderID: $o_id}) RETURN o", o_id=int(order_id)),
+        run(query, o_id=int(order_id)))
+
+    full_docs = []
+    for result in results:
+        # Combine both the product node and order-detail node into one.
+        full_doc = {}
+        full_doc.update(result['p'])
+        full_doc.update(result['od'])
+        full_docs.append(full_doc)
+
+    # Render the order and products in one pass.
+    return await render_template("expand.html", order=dict(order_data), products=full_docs)
@@ -0,0 +1,217 @@
+"""Every query the Northwind Neo4j apps send that depends on user input.
+
+User input only ever goes in as a parameter, never into the query text. Labels
+can't be parameters in Cypher, so they're checked against the labels that
+actually exist in the database first. The query text for each label is built
+once and reused. Neo4j caches query plans by their exact text, so a repeated
+search or page of /raw reuses the plan it already has.
+
+    from queries import Queries
+    queries = Queries(graph)
+    products = queries.search_products("cho")
+"""
+
+import threading
+import time
+
+from cache import LRUCache
+
+# Fixed query text. $search, $after and $limit are parameters, filled in by the
+# driver. ($param works on Neo4j 3 and 4. The older {param} was removed in 4.0.)
+SEARCH_PRODUCTS = """
+    MATCH (p:Product)
+    WHERE toLower(p.ProductName) CONTAINS toLower($search)
+    RETURN p
+"""
+
+LABELS = "CALL db.labels() YIELD label RETURN collect(label);"
+
+# Query text per label. {label} is filled in once per label, after it has been
+# checked, and the result is kept in Queries.prepared.
+LABEL_PAGE = """
+    MATCH (n:{label})
+    WHERE {after}
+    RETURN n
+    ORDER BY {order}
+    LIMIT $limit
+"""
+
+# Labels without a key in PAGE_KEYS only have a first page.
+LABEL_FIRST_PAGE = """
+    MATCH (n:{label})
+    RETURN n
+    LIMIT $limit
+"""
+
+LABEL_ALL = """
+    MATCH (n:{label})
+    RETURN n
+"""
+
+# The key each label is paged on: (property, type) pairs. These are the keys
+# load_data.py puts unique constraints on (and app.py, for Sequence), so a page
+# is a range seek on the constraint's index, read in index order. Order-Detail
+# and Employee-Territory have two part keys. They're paged on the first part,
+# which load_data.py indexes, with the second breaking ties.
+PAGE_KEYS = {
+    'Category': [('CategoryID', int)],
+    'Customer': [('CustomerID', str)],
+    'Employee': [('EmployeeID', int)],
+    'Employee-Territory': [('EmployeeID', int), ('TerritoryID', str)],
+    'Order': [('OrderID', int)],
+    'Order-Detail': [('OrderID', int), ('ProductID', int)],
+    'Product': [('ProductID', int)],
+    'Region': [('RegionID', int)],
+    'Sequence': [('name', str)],
+    'Shipper': [('ShipperID', int)],
+    'Supplier': [('SupplierID', int)],
+    'Territory': [('TerritoryID', str)],
+}
+
+# Smaller than any key of each type, so the first page is the same query as
+# the rest. (Neo4j integers are 64 bit. Keys are never empty strings.)
+FIRST_KEY = {int: -2 ** 63, str: ''}
+
+class UnknownLabel(ValueError):
+    """Raised when asked for a label that isn't in the database."""
+
+def quote_label(label):
+    """Backtick quotes a label so names like Order-Detail can be used in a query."""
+    return "`" + label.replace("`", "``") + "`"
+
+def strip_label(label):
+    """raw.html links to labels with a '-' in them as `Order-Detail`, with the
+    backticks. Returns the plain name."""
+    if len(label) > 1 and label.startswith("`") and label.endswith("`"):
+        return label[1:-1]
+    return label
+
+def page_query(label):
+    """Query text for one page of a checked label. The key of the last node on
+    the previous page goes in $after (and $after2 for two part keys)."""
+    keys = PAGE_KEYS.get(label)
+    if keys is None:
+        return LABEL_FIRST_PAGE.format(label=quote_label(label))
+
+    first = "n.{}".format(keys[0][0])
+    if len(keys) == 1:
+        after = first + " > $after"
+    else:
+        # The >= on its own is what the index seeks on, like the feed cursors
+        # in neo_tweet.py.
+        after = "{0} >= $after AND ({0} > $after OR n.{1} > $after2)".format(first, keys[1][0])
+    order = ", ".join("n." + key for key, _ in keys)
+    return LABEL_PAGE.format(label=quote_label(label), after=after, order=order)
+
+def page_params(after):
+    """The $after / $after2 parameters for a key tuple."""
+    return dict(zip(('after', 'after2'), after))
+
+def first_key(label):
+    """The key to pass to get the first page of a label, or None if it can't
+    be paged."""
+    keys = PAGE_KEYS.get(label)
+    if keys is None:
+        return None
+    return tuple(FIRST_KEY[kind] for _, kind in keys)
+
+def last_key(label, node):
+    """The key of a node, to get the page after it."""
+    return tuple(node[key] for key, _ in PAGE_KEYS[label])
+
+def format_cursor(key):
+    """A key tuple as it goes in ?after=, e.g. '10248' or '10248,11'."""
+    return ",".join(str(value) for value in key)
+
+def parse_cursor(label, text):
+    """The key tuple from ?after=. Raises ValueError if it doesn't fit the
+    label's key, or the label can't be paged."""
+    keys = PAGE_KEYS.get(label)
+    if keys is None:
+        raise ValueError("{} has no key to page on".format(label))
+    # Only the last part can be a string, so it gets anything left over.
+    parts = text.split(",", len(keys) - 1)
+    if len(parts) != len(keys):
+        raise ValueError("Expected {} values in {!r}".format(len(keys), text))
+    return tuple(kind(part) for (_, kind), part in zip(keys, parts))
+
+class Queries:
+    """Runs the queries above against a py2neo Graph."""
+
+    def __init__(self, graph, labels_ttl=60, refresh_interval=10):
+        self.graph = graph
+        # Labels hardly ever change, but new ones should show up eventually.
+        self.labels_cache = LRUCache(maxsize=1, ttl=labels_ttl)
+        # The list is read again early when asked for a label that isn't in it,
+        # but at most this often. See check_label().
+        self.refresh_interval = refresh_interval
+        self.last_refresh = None
+        self.lock = threading.Lock()
+        # (template, label) -> finished query text.
+        self.prepared = {}
+
+    def labels(self):
+        """Every label in the database, sorted."""
+        return self.labels_cache.get_or_load(
+            'labels', lambda: sorted(self.graph.evaluate(LABELS) or []))
+
+    def check_label(self, label):
+        """Returns the plain label name if it exists, otherwise raises UnknownLabel."""
+        label = strip_label(label)
+        if label not in self.labels():
+            # It may have been created since the list was cached, so look
+            # again. That's rate limited, so requests for made up labels can't
+            # make every request go to the database.
+            if not self.refresh_labels() or label not in self.labels():
+                raise UnknownLabel(label)
+        return label
+
+    def refresh_labels(self):
+        """Drops the cached labels so the next call to labels() reads them
+        again, unless that was done in the last 'refresh_interval' seconds.
+        Returns whether they were dropped."""
+        now = time.monotonic()
+        with self.lock:
+            if self.last_refresh is not None and now - self.last_refresh < self.refresh_interval:
+                return False
+            self.last_refresh = now
+        self.labels_cache.clear()
+        return True
+
+    def prepare(self, template, label):
+        """Query text for template with a checked label filled in. Always the
+        same string for the same label."""
+        label = self.check_label(label)
+        key = (template, label)
+        if key not in self.prepared:
+            self.prepared[key] = template.format(label=quote_label(label))
+        return self.prepared[key]
+
+    def search_products(self, search_string):
+        """Products whose name contains search_string, ignoring case."""
+        return [record[0] for record in self.graph.run(SEARCH_PRODUCTS, search=search_string)]
+
+    def label_page(self, label, after=None, limit=100):
+        """Up to 'limit' nodes with the label, in order of its key (see
+        PAGE_KEYS), starting after the key 'after' (from parse_cursor()), or
+        from the start. Returns (nodes, cursor for the page after them), where
+        the cursor is None if there's nothing to page on."""
+        label = self.check_label(label)
+        key = ('page', label)
+        if key not in self.prepared:
+            self.prepared[key] = page_query(label)
+
+        if after is None:
+            after = first_key(label)
+        params = page_params(after) if after is not None else {}
+        nodes = [record[0] for record in self.graph.run(self.prepared[key], limit=limit, **params)]
+
+        cursor = None
+        if nodes and label in PAGE_KEYS:
+            cursor = format_cursor(last_key(label, nodes[-1]))
+        return nodes, cursor
+
+    def label_nodes(self, label):
+        """Every node with the label, read from the cursor as they're used."""
+        query = self.prepare(LABEL_ALL, label)
+        return (record[0] for record in self.graph.run(query))
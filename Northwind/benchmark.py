@@ -0,0 +1,105 @@
+"""Compares requests per second between the sync (app.py) and async
+(async_app.py) versions of a Northwind app.
+
+Start both versions against the same local database, e.g. for Mongo:
+    $ docker run -d -p 27017:27017 mongo
+    $ mongorestore --db Northwind Mongo/dump/dump/Northwind
+    $ cd Mongo
+    $ mongo_uri=mongodb://localhost:27017/Northwind FLASK_APP=app.py flask run --port 5000 --with-threads
+    $ mongo_uri=mongodb://localhost:27017/Northwind hypercorn async_app:app --bind localhost:8000
+
+Then run:
+    $ python benchmark.py http://localhost:5000 http://localhost:8000
+
+For Neo4j both apps have to reach the same server. The async driver only talks
+to Neo4j 4.4 and newer, and the py2neo 4.0 pinned in requirements.txt only to
+3.x, so run a 4.4 server and give the sync app py2neo 2021.2, which talks to
+both (the Neo4j app and load_data.py only send $param queries, which 3.x and
+4.x both accept):
+    $ docker run -d -p 7687:7687 -e NEO4J_AUTH=neo4j/password neo4j:4.4
+    $ pip install -r requirements.txt && pip install py2neo==2021.2.4
+    $ export neo4j_uri=bolt://localhost:7687 neo4j_password=password
+    $ python northwind-mongo-master/load_data.py
+    $ cd Neo4j
+    $ FLASK_APP=app.py flask run --port 5000 --with-threads
+    $ hypercorn async_app:app --bind localhost:8000    (from the requirements-async.txt environment)
+    $ python ../benchmark.py --backend neo4j http://localhost:5000 http://localhost:8000
+
+Only the standard library is used, so this can run from any environment.
+"""
+
+import argparse
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+from urllib.request import urlopen
+
+# (method, path, form data) for each request type, per backend. Each one is run
+# on its own. /raw takes a collection name in the Mongo apps and a label in the
+# Neo4j ones.
+REQUESTS = {
+    'mongo': [
+        ("POST", "/search", {"data": "ch"}),
+        ("GET", "/raw/products", None),
+        ("GET", "/expand_order/10248", None),
+    ],
+    'neo4j': [
+        ("POST", "/search", {"data": "ch"}),
+        ("GET", "/raw/Product", None),
+        ("GET", "/expand_order/10248", None),
+    ],
+}
+
+def timed_request(url, data):
+    """Makes one request and returns how long it took in seconds, or None if
+    it failed."""
+    start = time.perf_counter()
+    try:
+        with urlopen(url, data=data, timeout=30) as response:
+            response.read()
+    except OSError:
+        return None
+    return time.perf_counter() - start
+
+def benchmark(base_url, method, path, form, num_requests, concurrency):
+    """Fires num_requests requests at the url, 'concurrency' at a time.
+
+    returns: (requests per second, median latency, number of failures)
+    """
+    url = base_url.rstrip('/') + path
+    data = urlencode(form).encode() if method == "POST" else None
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        times = list(pool.map(lambda _: timed_request(url, data), range(num_requests)))
+    elapsed = time.perf_counter() - start
+
+    succeeded = [t for t in times if t is not None]
+    median = statistics.median(succeeded) if succeeded else float('nan')
+    return len(succeeded) / elapsed, median, len(times) - len(succeeded)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("sync_url", help="Base url of the sync app, e.g. http://localhost:5000")
+    parser.add_argument("async_url", help="Base url of the async app, e.g. http://localhost:8000")
+    parser.add_argument("--backend", choices=sorted(REQUESTS), default="mongo",
+                        help="Which pair of apps is running, so the right routes are used")
+    parser.add_argument("--requests", type=int, default=1000, help="Requests per route")
+    parser.add_argument("--concurrency", type=int, default=50, help="Requests in flight at once")
+    args = parser.parse_args()
+
+    print("{:<24} {:>12} {:>12} {:>14} {:>14}".format(
+        "Route", "sync req/s", "async req/s", "sync median", "async median"))
+    for method, path, form in REQUESTS[args.backend]:
+        sync_rate, sync_median, sync_failed = benchmark(
+            args.sync_url, method, path, form, args.requests, args.concurrency)
+        async_rate, async_median, async_failed = benchmark(
+            args.async_url, method, path, form, args.requests, args.concurrency)
+        print("{:<24} {:>12.1f} {:>12.1f} {:>12.1f}ms {:>12.1f}ms".format(
+            method + " " + path, sync_rate, async_rate, sync_median * 1000, async_median * 1000))
+        if sync_failed or async_failed:
+            print("    failed requests: {} sync, {} async".format(sync_failed, async_failed))
+
+if __name__ == "__main__":
+    main()
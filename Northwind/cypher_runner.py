@@ -0,0 +1,230 @@
+"""
+    Runs a file of Cypher statements (like load_relations.cypher) as fast as
+    their dependencies allow.
+
+    Each statement is read to see which labels and relationship types it
+    matches and which it creates or merges into. Schema statements (indexes and
+    constraints) go first, so the loads after them can use the indexes. After
+    that a statement waits only for earlier statements it depends on:
+        - it matches something an earlier statement creates
+        - it creates something an earlier statement matches or creates
+    Anything else runs at the same time on a pool of workers. Creating a
+    relationship counts as writing to the labels on both ends, since it locks
+    both nodes. That keeps two statements from linking the same nodes at once
+    and deadlocking.
+
+    At the end a report shows how long each statement took.
+
+    $ python cypher_runner.py load_relations.cypher --workers 4
+    $ python cypher_runner.py load_relations.cypher --dry-run
+"""
+
+import argparse
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+SCHEMA_STATEMENT = re.compile(r"^\s*(CREATE|DROP)\s+(INDEX|CONSTRAINT)\b", re.IGNORECASE)
+
+# Clause keywords, longest first so 'OPTIONAL MATCH' wins over 'MATCH' and
+# 'ON CREATE' over 'CREATE'.
+CLAUSE = re.compile(r"\b(OPTIONAL\s+MATCH|ON\s+CREATE|ON\s+MATCH|MATCH|MERGE|CREATE|SET|WITH|"
+                    r"UNWIND|RETURN|WHERE|LOAD\s+CSV|DELETE|REMOVE|FOREACH|CALL|USING)\b",
+                    re.IGNORECASE)
+
+# (variable:Label:Other {...}) -> variable, ':Label:Other'
+NODE = re.compile(r"\(\s*(\w*)\s*((?::\s*(?:`[^`]+`|\w+)\s*)*)")
+LABEL = re.compile(r":\s*(`[^`]+`|\w+)")
+
+# (a)-[r:TYPE]->(b), in either direction.
+RELATIONSHIP = re.compile(r"\(\s*(\w*)[^()]*\)\s*<?-\s*\[\s*\w*\s*(?::\s*(`[^`]+`|\w+))?[^\]]*\]\s*->?\s*\(\s*(\w*)")
+
+STRING = re.compile(r"\"(?:[^\"\\]|\\.)*\"|'(?:[^'\\]|\\.)*'")
+
+def split_statements(text):
+    """Splits a file on ';', ignoring ones inside strings, and drops // comments
+    and empty statements."""
+    statements = []
+    current = []
+    quote = None
+    for line in text.splitlines():
+        if quote is None and line.strip().startswith('//'):
+            continue
+        for char in line + '\n':
+            if quote is not None:
+                if char == quote:
+                    quote = None
+            elif char in ('"', "'"):
+                quote = char
+            elif char == ';':
+                statements.append(''.join(current).strip())
+                current = []
+                continue
+            current.append(char)
+    statements.append(''.join(current).strip())
+    return [statement for statement in statements if statement]
+
+class Statement:
+    """One statement from the file, and what it reads and writes."""
+
+    def __init__(self, number, text):
+        self.number = number
+        self.text = text
+        self.schema = bool(SCHEMA_STATEMENT.match(text))
+        self.reads = set()
+        self.writes = set()
+        self.depends_on = set()
+        self.duration = None
+        self.started = None
+        self.error = None
+        if not self.schema:
+            self.find_reads_and_writes()
+
+    def find_reads_and_writes(self):
+        text = STRING.sub('""', self.text)
+        clauses = list(CLAUSE.finditer(text))
+        variables = {}
+
+        for i, clause in enumerate(clauses):
+            keyword = ' '.join(clause.group(1).upper().split())
+            end = clauses[i + 1].start() if i + 1 < len(clauses) else len(text)
+            body = text[clause.end():end]
+
+            for variable, labels in NODE.findall(body):
+                labels = LABEL.findall(labels)
+                if variable and labels:
+                    variables[variable] = labels
+                if keyword in ('MATCH', 'OPTIONAL MATCH'):
+                    self.reads.update(labels)
+                elif keyword in ('CREATE', 'MERGE'):
+                    self.writes.update(labels)
+
+            for start, rel_type, finish in RELATIONSHIP.findall(body):
+                ends = variables.get(start, []) + variables.get(finish, [])
+                if keyword in ('MATCH', 'OPTIONAL MATCH'):
+                    self.reads.update([rel_type] if rel_type else [])
+                elif keyword in ('CREATE', 'MERGE'):
+                    self.writes.update(ends)
+                    self.writes.update([rel_type] if rel_type else [])
+
+    def conflicts_with(self, earlier):
+        """True if this statement has to wait for 'earlier' to finish."""
+        if earlier.schema:
+            return True
+        return bool(earlier.writes & (self.reads | self.writes) or earlier.reads & self.writes)
+
+    def summary(self):
+        if self.schema:
+            return ' '.join(self.text.split())[:60]
+        return "reads {} writes {}".format(','.join(sorted(self.reads)) or '-',
+                                           ','.join(sorted(self.writes)) or '-')
+
+def plan(text):
+    """Parses the statements and orders them: schema statements first, in file
+    order, then everything else. Each statement's depends_on is filled in with
+    the numbers of the statements it has to wait for."""
+    statements = [Statement(number, text) for number, text in enumerate(split_statements(text), 1)]
+    schema = [statement for statement in statements if statement.schema]
+    others = [statement for statement in statements if not statement.schema]
+
+    # Schema statements run one after another, before anything else.
+    for i, statement in enumerate(schema[1:], 1):
+        statement.depends_on.add(schema[i - 1].number)
+
+    # Waiting for the last schema statement means waiting for all of them.
+    for i, statement in enumerate(others):
+        for earlier in schema[-1:] + others[:i]:
+            if statement.conflicts_with(earlier):
+                statement.depends_on.add(earlier.number)
+    return schema + others
+
+def run_statements(graph, statements, workers=4):
+    """Runs each statement as soon as everything it depends on has finished.
+    A statement that depends on a failed load is skipped. A failed index only
+    makes things slower, so those don't stop anything."""
+    by_number = {statement.number: statement for statement in statements}
+    waiting = list(statements)
+    running = {}
+    done = set()
+    start = time.time()
+
+    def run_one(statement):
+        statement.started = time.time() - start
+        began = time.time()
+        try:
+            graph.run(statement.text)
+        except Exception as e:
+            statement.error = e
+        statement.duration = time.time() - began
+        return statement
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while waiting or running:
+            for statement in list(waiting):
+                if statement.depends_on <= done:
+                    waiting.remove(statement)
+                    failed = [number for number in statement.depends_on
+                              if by_number[number].error and not by_number[number].schema]
+                    if failed:
+                        statement.error = "skipped, depends on failed statement {}".format(failed[0])
+                        done.add(statement.number)
+                        continue
+                    running[pool.submit(run_one, statement)] = statement
+
+            if not running:
+                continue
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                done.add(running.pop(future).number)
+
+    return time.time() - start
+
+def print_report(statements, elapsed=None):
+    """A line per statement with when it started, how long it took and what
+    it waited for. Leave out 'elapsed' to just show the plan."""
+    print("{:>3} {:>8} {:>8}  {:<14} {}".format("#", "start", "time", "waits for", "statement"))
+    for statement in statements:
+        waits = ','.join(str(number) for number in sorted(statement.depends_on)) or '-'
+        if statement.duration is None:
+            timing = "{:>8} {:>8}".format("-", "-")
+        else:
+            timing = "{:>7.2f}s {:>7.2f}s".format(statement.started, statement.duration)
+        print("{:>3} {}  {:<14} {}".format(statement.number, timing, waits, statement.summary()))
+        if statement.error:
+            print("      error: {}".format(statement.error))
+
+    if elapsed is None:
+        return
+    total = sum(statement.duration or 0 for statement in statements)
+    print("Ran {} statements in {:.2f}s ({:.2f}s if run one at a time)".format(
+        len(statements), elapsed, total))
+
+def run_file(graph, filename, workers=4):
+    """Plans and runs a .cypher file, then prints the timing report."""
+    with open(filename) as f:
+        statements = plan(f.read())
+    elapsed = run_statements(graph, statements, workers)
+    print_report(statements, elapsed)
+    return statements
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs a file of Cypher statements in parallel where it can.")
+    parser.add_argument("filename")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--dry-run", action="store_true", help="Only show the plan")
+    args = parser.parse_args()
+
+    if args.dry_run:
+        with open(args.filename) as f:
+            print_report(plan(f.read()))
+        return
+
+    from py2neo import Graph
+    graph = Graph(os.environ.get('neo4j_uri', "bolt://localhost:7687"),
+                  auth=(os.environ.get('neo4j_user', "neo4j"),
+                        os.environ.get('neo4j_password', "password")))
+    run_file(graph, args.filename, args.workers)
+
+if __name__ == "__main__":
+    main()
@@ -4,6 +4,9 @@ import sqlite3
 import csv
 from py2neo import Graph, authenticate, DBMS
 
+import cypher_runner
+import parquet_export
+
 authenticate('localhost:7474', 'neo4j', 'password')
 
 my_dbms = DBMS()
@@ -13,20 +16,57 @@ print("Saving files to:", import_dir)
 conn = sqlite3.connect('northwind.db')
 sql_cursor = conn.cursor()
 
-def execute_sql_file(filename):
-    with open(filename) as sql_file:
-        full_text = sql_file.read()
-    lines = full_text.split(';')
-    for line in lines:
-        sql_cursor.execute(line + ';')
-        conn.commit()
+# Settings for loading a whole script at once. The journal is kept in memory
+# (so the transaction can still roll back) and nothing waits on fsync. That's
+# fine here since the database can always be rebuilt from the script.
+BULK_LOAD_PRAGMAS = [
+    ('journal_mode', 'MEMORY'),
+    ('synchronous', 'OFF'),
+    ('foreign_keys', 'OFF'),
+    ('temp_store', 'MEMORY'),
+    ('cache_size', -262144),
+]
+
+def set_pragmas(pragmas):
+    """Sets each (name, value) pair and returns what they were before, in the
+    same form, so they can be put back afterwards."""
+    old = []
+    for name, value in pragmas:
+        old.append((name, conn.execute("PRAGMA {}".format(name)).fetchone()[0]))
+        conn.execute("PRAGMA {} = {}".format(name, value))
+    return old
+
+# How many rows export_csv holds in memory at once.
+EXPORT_CHUNK_SIZE = 5000
+
+def execute_sql_file(filename, encoding='latin-1'):
+    """Runs a .sql script in a single transaction. If any statement fails,
+    nothing in the script is kept. Northwind.Sqlite3.sql is Latin-1, not UTF-8."""
+    with open(filename, encoding=encoding) as sql_file:
+        script = sql_file.read()
 
-def export_csv(curs, name):
+    # The connection's own settings are put back afterwards, whatever they were.
+    old_pragmas = set_pragmas(BULK_LOAD_PRAGMAS)
+    try:
+        conn.executescript("BEGIN;\n" + script + "\nCOMMIT;")
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+    finally:
+        set_pragmas(old_pragmas)
+
+def export_csv(curs, name, chunk_size=EXPORT_CHUNK_SIZE):
+    """Writes the rows from a cursor to <import_dir>/<name>.csv, 'chunk_size'
+    rows at a time, so memory use doesn't grow with the number of rows."""
     headers = [desc[0] for desc in curs.description]
-    with open('{}/{}.csv'.format(import_dir, name), 'w') as f:
+    with open('{}/{}.csv'.format(import_dir, name), 'w', newline='') as f:
         writer = csv.writer(f)
         writer.writerow(headers)
-        writer.writerows(list(curs))
+        while True:
+            rows = curs.fetchmany(chunk_size)
+            if not rows:
+                break
+            writer.writerows(rows)
 
 def get_data_for_export():
     curs = sql_cursor.execute("SELECT * FROM orders " \
@@ -37,18 +77,21 @@ def get_data_for_export():
         curs = sql_cursor.execute("SELECT * FROM {}".format(table))
         export_csv(curs, table)
 
-def load_csv_to_neo():
-    g = Graph(password='password')
-    with open("load_relations.cypher") as f:
-        file_string = f.read()
-    queries = file_string.split(';')
+def get_data_for_parquet_export(directory='Parquet_Files', columns=None, partition_by_year=True):
+    """The same tables as get_data_for_export, as typed, compressed Parquet files
+    for analysis. Orders are split into a directory per year. 'columns' maps a
+    table to the columns to keep. Needs pyarrow, see parquet_export.py."""
+    parquet_export.export_all(conn, directory, columns, partition_by_year)
 
-    for query in queries:
-        print("Running:\n", repr(query))
-        g.run(query)
+def load_csv_to_neo(workers=4):
+    """Runs load_relations.cypher. Indexes are created first and loads that
+    don't touch the same labels run at the same time. See cypher_runner.py."""
+    g = Graph(password='password')
+    cypher_runner.run_file(g, "load_relations.cypher", workers)
 
 #execute_sql_file('Northwind.Sqlite3.sql')
 #get_data_for_export()
+#get_data_for_parquet_export()
 load_csv_to_neo()
 
 conn.close()
@@ -1,86 +1,232 @@
+"""
+    Loads the Northwind CSVs in this folder into Neo4j.
+
+    Everything is read from the local files, so no internet connection is
+    needed. Each column is converted to the type declared in TABLES below, so
+    IDs are numbers and compare as numbers. The order of work is:
+        1. constraints and indexes
+        2. nodes, sent in batches with UNWIND
+        3. relationships, where each end is found through the indexes from step 1
+
+    Everything uses MERGE, so the load can be run again without making duplicates.
+
+    Set 'neo4j_uri' / 'neo4j_user' / 'neo4j_password' to point it at your database:
+        $ neo4j_uri=bolt://localhost:7687 python load_data.py
+"""
+
+import csv
+import io
+import os
+import time
+from datetime import datetime
+
 from py2neo import Graph
 
 # Connect to the graph. You will need to change this for your Sandbox
-graph = Graph("bolt://18.207.142.251:34366",
-              auth=("neo4j", "capitals-photodiode-winter"))
-
-# Since the CSV filenames are all plural and we want the labels to be singular,
-# this is just a simple map from plural to singularself.
-# NOTE: names with dashes are escaped in the singular form with backquotes.
-singular_form = {
-    'categories': 'Category',
-    'customers': 'Customer',
-    'employee-territories': '`Employee-Territory`',
-    'employees': 'Employee',
-    'order-details': '`Order-Detail`',
-    'orders': 'Order',
-    'products': 'Product',
-    'regions': 'Region',
-    'shippers': 'Shipper',
-    'suppliers': 'Supplier',
-    'territories': 'Territory'
-}
+graph = Graph(os.environ.get('neo4j_uri', "bolt://localhost:7687"),
+              auth=(os.environ.get('neo4j_user', "neo4j"),
+                    os.environ.get('neo4j_password', "password")))
+
+CSV_DIR = os.path.dirname(os.path.abspath(__file__))
+
+BATCH_SIZE = 1000
 
-# This is just the headers from each of the CSV files. Easier to put them here than require each student to download all the files.
-all_headers = {
-    'categories': ['CategoryID', 'CategoryName', 'Description', 'Picture'],
-    'customers': ['CustomerID', 'CompanyName', 'ContactName', 'ContactTitle', 'Address', 'City', 'Region', 'PostalCode', 'Country', 'Phone', 'Fax'],
-    'employee-territories': ['EmployeeID', 'TerritoryID'],
-    'employees': ['EmployeeID', 'LastName', 'FirstName', 'Title', 'TitleOfCourtesy', 'BirthDate', 'HireDate', 'Address', 'City', 'Region', 'PostalCode', 'Country', 'HomePhone', 'Extension', 'Photo', 'Notes', 'ReportsTo', 'PhotoPath'],
-    'order-details': ['OrderID', 'ProductID', 'UnitPrice', 'Quantity', 'Discount'],
-    'orders': ['OrderID', 'CustomerID', 'EmployeeID', 'OrderDate', 'RequiredDate', 'ShippedDate', 'ShipVia', 'Freight', 'ShipName', 'ShipAddress', 'ShipCity', 'ShipRegion', 'ShipPostalCode', 'ShipCountry'],
-    'products': ['ProductID', 'ProductName', 'SupplierID', 'CategoryID', 'QuantityPerUnit', 'UnitPrice', 'UnitsInStock', 'UnitsOnOrder', 'ReorderLevel', 'Discontinued'],
-    'regions': ['RegionID', 'RegionDescription'],
-    'shippers': ['ShipperID', 'CompanyName', 'Phone'],
-    'suppliers': ['SupplierID', 'CompanyName', 'ContactName', 'ContactTitle', 'Address', 'City', 'Region', 'PostalCode', 'Country', 'Phone', 'Fax', 'HomePage'],
-    'territories': ['TerritoryID', 'TerritoryDescription', 'RegionID']
+def timestamp(value):
+    """'1996-07-04 00:00:00.000' -> '1996-07-04T00:00:00', the same format the
+    apps use for new orders."""
+    return datetime.strptime(value, '%Y-%m-%d %H:%M:%S.%f').isoformat()
+
+def boolean(value):
+    return value not in ('0', 'false', 'False')
+
+# One entry per CSV file:
+#   label:    node label. Names with dashes are escaped with backquotes.
+#   key:      column(s) that identify a node. A single key gets a unique
+#             constraint, several get an index on the first one.
+#   types:    columns that aren't strings, and what to convert them with.
+#   skip:     columns that aren't loaded. The Picture / Photo columns are
+#             hex dumps of old bitmaps, not usable images.
+#   overflow: a free text column that takes any extra commas in a row. See read_rows.
+TABLES = {
+    'categories': {
+        'label': 'Category',
+        'key': ['CategoryID'],
+        'types': {'CategoryID': int},
+        'skip': ['Picture']
+    },
+    'customers': {
+        'label': 'Customer',
+        'key': ['CustomerID'],
+        'types': {}
+    },
+    'employees': {
+        'label': 'Employee',
+        'key': ['EmployeeID'],
+        'types': {'EmployeeID': int, 'ReportsTo': int, 'BirthDate': timestamp, 'HireDate': timestamp},
+        'skip': ['Photo'],
+        'overflow': 'Notes'
+    },
+    'employee-territories': {
+        'label': '`Employee-Territory`',
+        'key': ['EmployeeID', 'TerritoryID'],
+        # TerritoryIDs are zip codes, so they stay strings to keep leading zeros.
+        'types': {'EmployeeID': int}
+    },
+    'orders': {
+        'label': 'Order',
+        'key': ['OrderID'],
+        'types': {'OrderID': int, 'EmployeeID': int, 'OrderDate': timestamp,
+                  'RequiredDate': timestamp, 'ShippedDate': timestamp,
+                  'ShipVia': int, 'Freight': float}
+    },
+    'order-details': {
+        'label': '`Order-Detail`',
+        'key': ['OrderID', 'ProductID'],
+        'types': {'OrderID': int, 'ProductID': int, 'UnitPrice': float,
+                  'Quantity': int, 'Discount': float}
+    },
+    'products': {
+        'label': 'Product',
+        'key': ['ProductID'],
+        'types': {'ProductID': int, 'SupplierID': int, 'CategoryID': int,
+                  'UnitPrice': float, 'UnitsInStock': int, 'UnitsOnOrder': int,
+                  'ReorderLevel': int, 'Discontinued': boolean}
+    },
+    'regions': {
+        'label': 'Region',
+        'key': ['RegionID'],
+        'types': {'RegionID': int}
+    },
+    'shippers': {
+        'label': 'Shipper',
+        'key': ['ShipperID'],
+        'types': {'ShipperID': int}
+    },
+    'suppliers': {
+        'label': 'Supplier',
+        'key': ['SupplierID'],
+        'types': {'SupplierID': int}
+    },
+    'territories': {
+        'label': 'Territory',
+        'key': ['TerritoryID'],
+        'types': {'RegionID': int}
+    }
 }
 
-# Find all the filenames
-for filename in singular_form:
-    print(filename)
+# (table, relationship type, other table, {column in table: key of other table})
+RELATIONSHIPS = [
+    ('order-details', 'PART_OF', 'orders', {'OrderID': 'OrderID'}),
+    ('order-details', 'IS', 'products', {'ProductID': 'ProductID'}),
+    ('products', 'IS_CATEGORY', 'categories', {'CategoryID': 'CategoryID'}),
+]
+
+def read_rows(table):
+    """Yields each row of a CSV as a dict, with values converted to their
+    declared types. 'NULL' and empty values are left out.
 
-    headers = all_headers[filename]
+    The files aren't quoted properly: free text like 'Soft drinks, coffees'
+    has bare commas in it, and some addresses have line breaks. Commas followed
+    by a space are treated as part of the text, a row that ends early is joined
+    with the next line, and anything else left over goes in the overflow column."""
+    schema = TABLES[table]
+    with open(os.path.join(CSV_DIR, table + '.csv'), newline='', encoding='utf-8') as f:
+        text = f.read().replace(', ', '\0')
 
-    # Create a string for each node property in the form "Property: row.Property"
-    property_strings = ["{0}: row.{0}".format(header) for header in headers]
-    # This will produce: property_strings = [header1: row.header1, header2: row.header2, ...]
+    reader = csv.reader(io.StringIO(text))
+    headers = next(reader)
+    partial = None
+    for values in reader:
+        values = [value.replace('\0', ', ') for value in values]
+        if partial is not None:
+            values = partial[:-1] + [partial[-1] + '\n' + values[0]] + values[1:]
+            partial = None
+        if len(values) < len(headers):
+            partial = values
+            continue
 
-    node_label = singular_form.get(filename)
+        extra = len(values) - len(headers)
+        if extra and schema.get('overflow'):
+            at = headers.index(schema['overflow'])
+            values[at:at + extra + 1] = [','.join(values[at:at + extra + 1])]
 
-    # Create the string that goes after the CREATE statement.
-    node_string = "(:{0} {{{1}}})".format(node_label, ", ".join(property_strings))
-    # This will produce: node_string = "(:node_label {header1: row.header1, header2: row.header2, ...})"
-    # print(node_string)
+        row = {}
+        for header, value in zip(headers, values):
+            value = value.strip()
+            if header in schema.get('skip', []) or value in ('', 'NULL'):
+                continue
+            row[header] = schema['types'].get(header, str)(value)
+        yield row
 
-    # Build the full query, and run.
+def chunks(rows, size):
+    """Splits a list of rows into lists of at most 'size' rows."""
+    for start in range(0, len(rows), size):
+        yield rows[start:start + size]
+
+def match_pattern(variable, table, values):
+    """'(variable:Label {Key: values.Key, ...})' for matching a node of 'table'
+    by its key, where 'values' names the map the keys come from."""
+    schema = TABLES[table]
+    keys = ", ".join("{0}: {1}.{0}".format(key, values) for key in schema['key'])
+    return "({}:{} {{{}}})".format(variable, schema['label'], keys)
+
+def create_schema():
+    """Constraints and indexes on every key, before anything is loaded, so the
+    MERGEs and relationship lookups below are index lookups.
+
+    Ones that already exist are skipped. Neo4j 4 raises an error for creating
+    them again, so otherwise this could only be run once."""
+    for schema in TABLES.values():
+        # get_indexes() lists uniqueness constraints too, by the plain label.
+        if (schema['key'][0],) in graph.schema.get_indexes(schema['label'].strip('`')):
+            continue
+        if len(schema['key']) == 1:
+            graph.run("CREATE CONSTRAINT ON (n:{}) ASSERT n.{} IS UNIQUE;".format(
+                schema['label'], schema['key'][0]))
+        else:
+            graph.run("CREATE INDEX ON :{}({});".format(schema['label'], schema['key'][0]))
+
+def load_nodes(table, rows, batch_size=BATCH_SIZE):
+    """MERGEs one node per row on its key and sets every other column."""
     query = """
-    USING PERIODIC COMMIT
-    LOAD CSV WITH HEADERS FROM "https://raw.githubusercontent.com/najarvis/DatabaseResearchCode/master/Northwind/northwind-mongo-master/{s_filename}.csv" AS row
-    CREATE {n_string};
-    """.format(s_filename=filename, n_string=node_string)
-    # print(query)
-
-    graph.run(query)
-
-# Create the basic relationships
-query = """
-MATCH (od:`Order-Detail`), (o:Order)
-WHERE od.OrderID = o.OrderID
-CREATE (od)-[:PART_OF]->(o);
-"""
-graph.run(query)
+        UNWIND $rows AS row
+        MERGE {node}
+        SET n += row
+    """.format(node=match_pattern('n', table, 'row'))
+    for batch in chunks(rows, batch_size):
+        graph.run(query, rows=batch)
 
-query2 = """
-MATCH (od:`Order-Detail`), (p:Product)
-WHERE od.ProductID = p.ProductID
-CREATE (od)-[:IS]->(p);
-"""
-graph.run(query2)
+def load_relationships(table, rel_type, other, columns, rows, batch_size=BATCH_SIZE):
+    """Links each row's node to the 'other' node its columns point at."""
+    other_keys = ", ".join("{}: row.{}".format(key, column) for column, key in columns.items())
+    query = """
+        UNWIND $rows AS row
+        MATCH {node}
+        MATCH (b:{other_label} {{{other_keys}}})
+        MERGE (a)-[:{rel_type}]->(b)
+    """.format(node=match_pattern('a', table, 'row'), other_label=TABLES[other]['label'],
+               other_keys=other_keys, rel_type=rel_type)
 
-query3 = """
-MATCH (p:Product), (c:Category)
-WHERE p.CategoryID = c.CategoryID
-CREATE (p)-[:IS_CATEGORY]->(c)
-"""
-graph.run(query3)
+    # Only the columns used to find each end are sent.
+    needed = TABLES[table]['key'] + list(columns)
+    rows = [{column: row.get(column) for column in needed} for row in rows]
+    for batch in chunks(rows, batch_size):
+        graph.run(query, rows=batch)
+
+def load_all(batch_size=BATCH_SIZE):
+    create_schema()
+
+    rows = {}
+    for table in TABLES:
+        start = time.time()
+        rows[table] = list(read_rows(table))
+        load_nodes(table, rows[table], batch_size)
+        print("{:<22} {:>6} nodes  {:.2f}s".format(table, len(rows[table]), time.time() - start))
+
+    for table, rel_type, other, columns in RELATIONSHIPS:
+        start = time.time()
+        load_relationships(table, rel_type, other, columns, rows[table], batch_size)
+        print("{:<22} {:>6} rels   {:.2f}s".format(rel_type, len(rows[table]), time.time() - start))
+
+if __name__ == "__main__":
+    load_all()
@@ -1,6 +1,13 @@
-import redis
+import os
+import sys
 
-REDIS_CONNECTION = redis.Redis() # Connect a local database.
+# connections.py is shared with the rest of the repo, and lives at the top of it.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from connections import redis_connection, pool_stats
+
+# A local database. Nothing connects until the first command, see connections.py.
+REDIS_CONNECTION = redis_connection("redis")
 
 def get_decoded(r, key):
     encoded = r.get(key)
@@ -46,16 +53,19 @@ def list_all_members(r):
                 print("\t{}".format(subbed.decode('utf-8')))
     print()
 
-create_user(REDIS_CONNECTION, 'Nick', 'najarvis')
-create_user(REDIS_CONNECTION, 'Tom', 'tomplaysminecraft')
-create_user(REDIS_CONNECTION, 'Roger', 'rman45')
-subscribe(REDIS_CONNECTION, 'rman45', 'najarvis')
-get_subscribers(REDIS_CONNECTION, 'najarvis')
-list_all_members(REDIS_CONNECTION)
-
-REDIS_CONNECTION.hset('nums', 'num', 0)
-print(REDIS_CONNECTION.hget('nums', 'num'))
-REDIS_CONNECTION.hincrby('nums', 'num')
-print(REDIS_CONNECTION.hget('nums', 'num'))
-REDIS_CONNECTION.hincrby('nums', 'num2')
-print(REDIS_CONNECTION.hget('nums', 'num2'))
+if __name__ == "__main__":
+    create_user(REDIS_CONNECTION, 'Nick', 'najarvis')
+    create_user(REDIS_CONNECTION, 'Tom', 'tomplaysminecraft')
+    create_user(REDIS_CONNECTION, 'Roger', 'rman45')
+    subscribe(REDIS_CONNECTION, 'rman45', 'najarvis')
+    get_subscribers(REDIS_CONNECTION, 'najarvis')
+    list_all_members(REDIS_CONNECTION)
+
+    REDIS_CONNECTION.hset('nums', 'num', 0)
+    print(REDIS_CONNECTION.hget('nums', 'num'))
+    REDIS_CONNECTION.hincrby('nums', 'num')
+    print(REDIS_CONNECTION.hget('nums', 'num'))
+    REDIS_CONNECTION.hincrby('nums', 'num2')
+    print(REDIS_CONNECTION.hget('nums', 'num2'))
+
+    print(pool_stats())
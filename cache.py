@@ -0,0 +1,212 @@
+"""Small in-process caches used in front of slow database queries and templates.
+
+There's one copy of this module for the whole repo. The Northwind apps add the
+top of the repo to sys.path to import it."""
+
+import threading
+import time
+from collections import OrderedDict
+
+from markupsafe import Markup
+
+# Returned by LRUCache.get when a key isn't cached, so that None can be cached
+# like any other value.
+MISSING = object()
+
+class LRUCache:
+    """A dictionary that holds at most 'maxsize' entries. When it fills up the
+    least recently used entry is thrown out. If 'ttl' (in seconds) is given,
+    entries older than that are treated as missing.
+
+    A typical usage would be:
+        cache = LRUCache(maxsize=512, ttl=60)
+        value = cache.get_or_load(key, lambda: expensive_query(key))
+
+    It can be shared between threads (e.g. a threaded Flask server). The lock
+    isn't held while get_or_load's loader runs, so two threads that miss at the
+    same time may both load the value.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # key -> (time stored, value). Most recently used keys are at the end.
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            return entry is not None and not self.expired(entry)
+
+    def expired(self, entry):
+        return self.ttl is not None and time.monotonic() - entry[0] > self.ttl
+
+    def get(self, key, default=None):
+        """Returns the cached value for key, or default if it isn't cached.
+        Counts towards hits/misses."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or self.expired(entry):
+                if entry is not None:
+                    self.entries.pop(key, None)
+                self.misses += 1
+                return default
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        """Stores a value, evicting the least recently used entry if full."""
+        with self.lock:
+            self.entries[key] = (time.monotonic(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def get_or_load(self, key, loader):
+        """Read-through lookup. If key isn't cached, loader() is called and
+        its result is stored."""
+        value = self.get(key, MISSING)
+        if value is MISSING:
+            value = loader()
+            self.put(key, value)
+        return value
+
+    def invalidate(self, key):
+        """Removes a single key, if it is cached."""
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def hit_rate(self):
+        """Fraction of lookups that were served from the cache."""
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self):
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hit_rate(),
+                "size": len(self.entries),
+                "maxsize": self.maxsize}
+
+class ReferenceCache:
+    """Cache for small lookup tables that hardly ever change (categories,
+    suppliers, ...), shared by every request in the process.
+
+    Each table is registered with a loader that returns the whole table (e.g.
+    a dict of ID -> name). Tables are only loaded the first time they're
+    asked for, and are reloaded once they are older than 'ttl' seconds. If a
+    table is registered with a 'version' function (something cheap, like a
+    count of the rows) it is called at most every 'check_interval' seconds,
+    and the table is reloaded early if the version has changed.
+
+    Like LRUCache it can be shared between threads, and the lock isn't held
+    while a loader or version function is querying the database.
+    """
+
+    def __init__(self, ttl=600, check_interval=30):
+        self.ttl = ttl
+        self.check_interval = check_interval
+        self.hits = 0
+        self.misses = 0
+        self.loaders = {}
+        self.versions = {}
+        # name -> [time loaded, time last checked, version, data]
+        self.tables = {}
+        self.lock = threading.Lock()
+
+    def register(self, name, loader, version=None):
+        with self.lock:
+            self.loaders[name] = loader
+            if version is not None:
+                self.versions[name] = version
+
+    def get(self, name):
+        """Returns the table, loading or reloading it if needed."""
+        now = time.monotonic()
+        with self.lock:
+            loader = self.loaders[name]
+            version = self.versions.get(name)
+            entry = self.tables.get(name)
+            fresh = entry is not None and now - entry[0] <= self.ttl
+            if fresh:
+                if version is None or now - entry[1] <= self.check_interval:
+                    self.hits += 1
+                    return entry[3]
+                # Marked as checked straight away, so other threads keep using
+                # the table while this one asks for the version.
+                entry[1] = now
+
+        current = version() if version is not None else None
+        if fresh and current == entry[2]:
+            with self.lock:
+                self.hits += 1
+            return entry[3]
+
+        data = loader()
+        with self.lock:
+            self.misses += 1
+            self.tables[name] = [now, now, current, data]
+        return data
+
+    def invalidate(self, name=None):
+        """Forces a table (or every table, if no name is given) to be reloaded
+        next time it's asked for."""
+        with self.lock:
+            if name is None:
+                self.tables.clear()
+            else:
+                self.tables.pop(name, None)
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "hit_rate": self.hit_rate(),
+                    "tables": sorted(self.tables)}
+
+class FragmentCache:
+    """Caches the html a template produces for a single document, keyed by the
+    template and the document's id. Nothing stored with the documents says
+    when they last changed, so an entry is only reused for 'ttl' seconds. A
+    changed document can show its old html until then.
+
+    Once installed on a Flask app, templates can call:
+        {{ fragment('product.html', product['ProductID'], product=product) }}
+    """
+
+    def __init__(self, maxsize=4096, ttl=60):
+        self.cache = LRUCache(maxsize, ttl)
+        self.env = None
+
+    def install(self, app):
+        # Fragments are rendered synchronously from inside other templates. An
+        # async app (e.g. Quart) gets a sync copy of its environment, with its
+        # own template cache since compiled templates can't be shared.
+        self.env = app.jinja_env
+        if self.env.is_async:
+            self.env = self.env.overlay(enable_async=False, cache_size=400)
+        app.add_template_global(self.render, 'fragment')
+
+    def render(self, template_name, doc_id, **context):
+        key = (template_name, doc_id)
+
+        def load():
+            return Markup(self.env.get_template(template_name).render(**context))
+
+        return self.cache.get_or_load(key, load)
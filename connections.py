@@ -0,0 +1,246 @@
+"""Shared, lazily created database connections.
+
+There's one copy of this module for the whole repo. Scripts in subdirectories
+add the top of the repo to sys.path to import it.
+
+Instead of connecting at import time, modules ask for a connection here:
+    GRAPH = neo4j_graph("neo_tweet", password="password")
+
+Nothing connects until the first time it's used. Every method call on it
+(GRAPH.run(...), REDIS.get(...), ...) checks out one of 'max_size' slots
+first, waiting up to 'timeout' seconds for one to free up, so the pool can be
+sized for the number of workers. pool_stats() reports how busy each pool is.
+
+Some calls hand back something that still needs the connection after they
+return: a py2neo cursor is read lazily, and a transaction runs until it's
+committed. Those keep their slot until they're finished with (see LEASES).
+Attributes that aren't methods (GRAPH.nodes, GRAPH.schema, ...) are passed
+straight through and aren't counted.
+
+The defaults can be changed with the 'pool_size' and 'pool_timeout' environment
+variables, or per connection with max_size= and timeout=.
+
+The database packages are imported when a connection is first made, so a
+script only needs the driver it actually uses.
+"""
+
+import inspect
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_POOL_SIZE = int(os.environ.get('pool_size', 10))
+DEFAULT_TIMEOUT = float(os.environ.get('pool_timeout', 30))
+
+class PoolTimeout(Exception):
+    """Raised when no connection frees up within the pool's timeout."""
+
+class ConnectionPool:
+    """Creates a connection the first time it's needed and limits how many
+    calls can use it at once. Keeps count of how long callers wait and how
+    many give up."""
+
+    def __init__(self, name, factory, max_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT,
+                 leases=None):
+        self.name = name
+        self.factory = factory
+        self.max_size = max_size
+        self.timeout = timeout
+        self.leases = leases or {}
+        self.slots = threading.BoundedSemaphore(max_size)
+        self.lock = threading.Lock()
+        self._handle = None
+
+        self.in_use = 0
+        self.checkouts = 0
+        self.failures = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    @property
+    def handle(self):
+        """The underlying Graph / Redis object, created on first use."""
+        if self._handle is None:
+            with self.lock:
+                if self._handle is None:
+                    self._handle = self.factory()
+        return self._handle
+
+    def acquire(self):
+        """Waits for a free slot. Every acquire() needs a release() later."""
+        start = time.perf_counter()
+        if not self.slots.acquire(timeout=self.timeout):
+            with self.lock:
+                self.failures += 1
+            raise PoolTimeout("No {} connection free after {}s".format(self.name, self.timeout))
+
+        waited = time.perf_counter() - start
+        with self.lock:
+            self.in_use += 1
+            self.checkouts += 1
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+
+    def release(self):
+        with self.lock:
+            self.in_use -= 1
+        self.slots.release()
+
+    @contextmanager
+    def checkout(self):
+        """Waits for a free slot, then yields the connection."""
+        self.acquire()
+        try:
+            yield self.handle
+        finally:
+            self.release()
+
+    def stats(self):
+        return {"connected": self._handle is not None,
+                "max_size": self.max_size,
+                "in_use": self.in_use,
+                "checkouts": self.checkouts,
+                "checkout_failures": self.failures,
+                "avg_wait": self.total_wait / self.checkouts if self.checkouts else 0.0,
+                "max_wait": self.max_wait}
+
+class Lease:
+    """Wraps something a method call returned that keeps using the connection,
+    like a cursor or a transaction, and holds the call's slot until it's done:
+    one of its 'finishers' is called, it's iterated to the end, used as a
+    context manager and exited, or garbage collected."""
+
+    def __init__(self, pool, wrapped, finishers):
+        self._pool = pool
+        self._wrapped = wrapped
+        self._finishers = finishers
+        self._held = True
+
+    def _release(self):
+        if self._held:
+            self._held = False
+            self._pool.release()
+
+    def __getattr__(self, name):
+        attr = getattr(self._wrapped, name)
+        if name not in self._finishers:
+            return attr
+
+        def finish(*args, **kwargs):
+            try:
+                return attr(*args, **kwargs)
+            finally:
+                self._release()
+        return finish
+
+    def __iter__(self):
+        try:
+            for item in self._wrapped:
+                yield item
+        finally:
+            self._release()
+
+    def __next__(self):
+        try:
+            return next(self._wrapped)
+        except StopIteration:
+            self._release()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        try:
+            exit = getattr(self._wrapped, '__exit__', None)
+            return exit(*exc_info) if exit is not None else None
+        finally:
+            self._release()
+
+    def __del__(self):
+        self._release()
+
+class LazyConnection:
+    """Stands in for the real connection object. Attributes are looked up on
+    the real object, and method calls go through a pool checkout."""
+
+    def __init__(self, pool):
+        self._pool = pool
+
+    def __getattr__(self, name):
+        attr = getattr(self._pool.handle, name)
+        # Only real methods. Driver objects like pymongo's Database define
+        # __call__, so callable() isn't enough.
+        if not inspect.ismethod(attr):
+            return attr
+
+        finishers = self._pool.leases.get(name)
+        if finishers is None:
+            def call(*args, **kwargs):
+                with self._pool.checkout():
+                    return attr(*args, **kwargs)
+            return call
+
+        def call_leased(*args, **kwargs):
+            self._pool.acquire()
+            try:
+                result = attr(*args, **kwargs)
+            except BaseException:
+                self._pool.release()
+                raise
+            return Lease(self._pool, result, finishers)
+        return call_leased
+
+    def __getitem__(self, key):
+        return self._pool.handle[key]
+
+# Methods whose results keep using the connection, and the methods on those
+# results that mean they're done with it, per driver.
+LEASES = {
+    'neo4j': {
+        'run': {'close', 'data', 'evaluate', 'stats', 'summary', 'to_table',
+                'to_subgraph', 'to_data_frame', 'to_series', 'to_ndarray', 'to_matrix'},
+        'begin': {'commit', 'rollback', 'finish'},
+    },
+}
+
+POOLS = {}
+
+def lazy_connection(name, factory, max_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT,
+                    leases=None):
+    """Registers a pool under 'name' and returns a LazyConnection for it.
+    Asking for the same name again returns a connection to the same pool."""
+    if name not in POOLS:
+        POOLS[name] = ConnectionPool(name, factory, max_size, timeout, leases)
+    return LazyConnection(POOLS[name])
+
+def neo4j_graph(name, *args, max_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT, **kwargs):
+    """A py2neo Graph. args and kwargs are passed straight to Graph(), and
+    its own pool is given the same size. (py2neo has no setting for how long
+    to wait for a connection, so only our slots use the timeout.)"""
+    def factory():
+        import py2neo
+        from py2neo import Graph
+        # The setting was renamed in py2neo 2020, and unknown ones are errors.
+        if int(py2neo.__version__.split('.')[0]) < 2020:
+            kwargs.setdefault('max_connections', max_size)
+        else:
+            kwargs.setdefault('max_size', max_size)
+        return Graph(*args, **kwargs)
+    return lazy_connection(name, factory, max_size, timeout, LEASES['neo4j'])
+
+def redis_connection(name, *args, max_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT, **kwargs):
+    """A redis.Redis. The driver's own pool is given the same size, and
+    the timeout is used for its sockets."""
+    def factory():
+        import redis
+        kwargs.setdefault('max_connections', max_size)
+        kwargs.setdefault('socket_timeout', timeout)
+        kwargs.setdefault('socket_connect_timeout', timeout)
+        return redis.Redis(*args, **kwargs)
+    return lazy_connection(name, factory, max_size, timeout)
+
+def pool_stats():
+    """Stats for every pool, keyed by name."""
+    return {name: pool.stats() for name, pool in POOLS.items()}
@@ -1,9 +1,12 @@
 """Basic querying with neo4j. Building a game database."""
 
 import datetime
-from py2neo import Graph, Node
+from py2neo import Node
 
-GRAPH = Graph(password="password")
+from connections import neo4j_graph
+
+# Connects on first use, not on import. See connections.py.
+GRAPH = neo4j_graph("neo_queries", password="password")
 
 def create_game(name):
     game_node = GRAPH.run("MATCH (c:Game {name: {n}}) RETURN c", n=name).evaluate()
@@ -44,22 +47,23 @@ def create_likes(person, game):
     GRAPH.run(query, game_name=game, person_name=person)
 
 
-create_console("Xbox", 400.00)
-create_console("PC", None)
-create_console("Nintendo Wii", 249.99)
-create_console("Nintendo Switch", 299.99)
-create_console("Nintendo Wii U", 299.99)
-create_game("Halo: Combat Evolved")
-create_game("Crackdown")
-create_is_on("Halo: Combat Evolved", "Xbox", datetime.date(2001, 11, 15).isoformat())
-create_is_on("Halo: Combat Evolved", "PC", datetime.date(2003, 9, 30).isoformat())
-create_is_on("Crackdown", "Xbox", datetime.date(2007, 2, 20).isoformat())
-create_is_on("Halo 2", "PC", datetime.date(2007, 5, 31).isoformat())
+if __name__ == "__main__":
+    create_console("Xbox", 400.00)
+    create_console("PC", None)
+    create_console("Nintendo Wii", 249.99)
+    create_console("Nintendo Switch", 299.99)
+    create_console("Nintendo Wii U", 299.99)
+    create_game("Halo: Combat Evolved")
+    create_game("Crackdown")
+    create_is_on("Halo: Combat Evolved", "Xbox", datetime.date(2001, 11, 15).isoformat())
+    create_is_on("Halo: Combat Evolved", "PC", datetime.date(2003, 9, 30).isoformat())
+    create_is_on("Crackdown", "Xbox", datetime.date(2007, 2, 20).isoformat())
+    create_is_on("Halo 2", "PC", datetime.date(2007, 5, 31).isoformat())
 
-create_person("Nick")
-create_likes("Nick", "Crackdown")
-create_likes("Nick", "Halo: Combat Evolved")
+    create_person("Nick")
+    create_likes("Nick", "Crackdown")
+    create_likes("Nick", "Halo: Combat Evolved")
 
-create_likes("Nick", "The Legend of Zelda: Breath of the Wild")
-create_is_on("The Legend of Zelda: Breath of the Wild", "Nintendo Switch", datetime.date(2017, 3, 3).isoformat())
-create_is_on("The Legend of Zelda: Breath of the Wild", "Nintendo Wii U", datetime.date(2017, 3, 3).isoformat())
+    create_likes("Nick", "The Legend of Zelda: Breath of the Wild")
+    create_is_on("The Legend of Zelda: Breath of the Wild", "Nintendo Switch", datetime.date(2017, 3, 3).isoformat())
+    create_is_on("The Legend of Zelda: Breath of the Wild", "Nintendo Wii U", datetime.date(2017, 3, 3).isoformat())
@@ -1,10 +1,17 @@
 """Basic twitter-like application that uses neo4j as a database"""
 
+import time
 from uuid import uuid4
+from collections import deque
 from datetime import datetime
-from py2neo import Graph, Node, Relationship
+from itertools import islice
+from py2neo import Node, Relationship
 
-GRAPH = Graph(password="password")
+from cache import LRUCache
+from connections import neo4j_graph
+
+# Connects on first use. See connections.py for pool size and stats.
+GRAPH = neo4j_graph("neo_tweet", password="password")
 
 def find_one(label, *args):
     """Finds a node given a label and any optional args we want to pass. A
@@ -39,6 +46,7 @@ def create_user(handle, **kwargs):
 
     user = Node("User", handle=handle, **kwargs)
     GRAPH.create(user)
+    AUTHOR_CACHE.invalidate(handle)
 
     print("Created User:", user.get('handle'))
 
@@ -73,35 +81,60 @@ def tweet(user, tweet_text):
               "t_on": tweet_datetime}
     GRAPH.run(query, **kwargs)
 
+    # Push the tweet into each follower's timeline, if fan-out is turned on.
+    if TIMELINE_STORE is not None:
+        TIMELINE_STORE.fan_out(user, timeline_key(tweet_datetime, tweet_id))
+
     print("Tweet created with id:", tweet_id)
     return tweet_id
 
 def like(user, tweet_id):
     """Creates a "LIKE" relationship between user and a tweet based on
-    the user's handle and the tweet's tweet_id field. This is an example on how
-    we can use py2neo's built in types and features to avoid writing cypher
-    queries. A more 'pythonic' approach.
+    the user's handle and the tweet's tweet_id field, and increments the
+    tweet's num_likes by 1.
 
-    Also increments the tweet's num_likes by 1.
-    """
-    # Tries to match the user node
-    user_node = find_one("User", "handle", user)
-    if user_node is None:
-        print("User:", user, "not found!")
-        return
+    This is all done by one query on the server. MERGE means liking the same
+    tweet twice does nothing, and the counter is only touched when the
+    relationship is new. Creating the relationship locks the tweet node, so
+    two people liking at the same time can't lose an update.
 
-    # Tries to match the tweet node
-    tweet_node = find_one("Tweet", "tweet_id", tweet_id)
-    if tweet_node is None:
-        print("Tweet:", tweet_id, "not found!")
-        return
-
-    # Increment the property value
-    tweet_node["num_likes"] += 1
-    GRAPH.push(tweet_node)
-
-    # Add to graph.
-    GRAPH.create(Relationship(user_node, "LIKES", tweet_node))
+    returns: the new number of likes, or None if the user or tweet wasn't found.
+    """
+    query = """
+        MATCH (u:User {handle: {handle}}), (t:Tweet {tweet_id: {tweet_id}})
+        MERGE (u)-[:LIKES]->(t)
+        ON CREATE SET t.num_likes = t.num_likes + 1
+        RETURN t.num_likes;
+    """
+    num_likes = GRAPH.evaluate(query, handle=user, tweet_id=tweet_id)
+    if num_likes is None:
+        print("User:", user, "or Tweet:", tweet_id, "not found!")
+    return num_likes
+
+def chunks(rows, size):
+    """Splits an iterable up into lists of at most 'size' elements."""
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def like_many(likes, batch_size=1000):
+    """Bulk version of like(), for replaying a stream of (handle, tweet_id)
+    pairs. Each batch is a single query. Replaying the same likes again
+    doesn't change anything."""
+    query = """
+        UNWIND {rows} AS row
+        MATCH (u:User {handle: row.handle}), (t:Tweet {tweet_id: row.tweet_id})
+        MERGE (u)-[:LIKES]->(t)
+        ON CREATE SET t.num_likes = t.num_likes + 1;
+    """
+    rows = ({"handle": handle, "tweet_id": tweet_id} for handle, tweet_id in likes)
+    for batch in chunks(rows, batch_size):
+        GRAPH.run(query, rows=batch)
 
 def follow(follower, followed):
     """Similar to the 'like' function, this provides a way for users to follow each other."""
@@ -115,20 +148,232 @@ def follow(follower, followed):
 
     GRAPH.create(Relationship(follower_node, "FOLLOWS", followed_node))
 
-def get_full_feed():
+# Bulk importing. Each batch of rows is one UNWIND query (and so one
+# transaction). The uniqueness constraints from create_indexes() do the
+# "already exists" checks, and MERGE means re-running an import is harmless.
+
+def import_rows(query, rows, batch_size, name, on_batch=None):
+    """Runs the query once per batch of rows and prints how fast it went.
+    on_batch, if given, is called with each batch once it has been written.
+
+    returns: the number of rows sent
+    """
+    # MERGE on handle / tweet_id needs the constraints, both to be an index
+    # lookup and to stop two imports creating the same node.
+    create_indexes()
+
+    start = time.perf_counter()
+    total = 0
+    for batch in chunks(rows, batch_size):
+        GRAPH.run(query, rows=batch)
+        if on_batch is not None:
+            on_batch(batch)
+        total += len(batch)
+
+    elapsed = time.perf_counter() - start
+    rate = total / elapsed if elapsed > 0 else 0
+    print("Imported {} {} in {:.2f}s ({:.0f} rows/s)".format(total, name, elapsed, rate))
+    return total
+
+def import_users(users, batch_size=1000):
+    """users is an iterable of dicts, each with a 'handle' and any other
+    properties, e.g. {"handle": "@nickj", "name": "Nick Jarvis"}"""
+    query = """
+        UNWIND {rows} AS row
+        MERGE (u:User {handle: row.handle})
+        ON CREATE SET u += row;
+    """
+
+    def forget_cached(batch):
+        # Looking a user up before they were imported caches them as missing.
+        for row in batch:
+            AUTHOR_CACHE.invalidate(row['handle'])
+
+    return import_rows(query, users, batch_size, "users", forget_cached)
+
+def import_follows(follows, batch_size=1000):
+    """follows is an iterable of (follower, followed) handle pairs."""
+    query = """
+        UNWIND {rows} AS row
+        MATCH (a:User {handle: row.follower}), (b:User {handle: row.followed})
+        MERGE (a)-[:FOLLOWS]->(b);
+    """
+    rows = ({"follower": follower, "followed": followed} for follower, followed in follows)
+    return import_rows(query, rows, batch_size, "follows")
+
+def import_tweets(tweets, batch_size=1000):
+    """tweets is an iterable of dicts with a 'handle' and 'text'. 'tweet_id'
+    and 'tweeted_on' are filled in like tweet() does if they're missing.
+    Imported tweets are not fanned out to timelines."""
+    query = """
+        UNWIND {rows} AS row
+        MATCH (u:User {handle: row.handle})
+        MERGE (t:Tweet {tweet_id: row.tweet_id})
+        ON CREATE SET t.text = row.text, t.num_likes = 0, t.tweeted_on = row.tweeted_on
+        MERGE (u)-[:TWEETED]->(t);
+    """
+    rows = ({"handle": t['handle'],
+             "text": t['text'],
+             "tweet_id": t.get('tweet_id') or str(uuid4()),
+             "tweeted_on": t.get('tweeted_on') or datetime.now().isoformat()}
+            for t in tweets)
+    return import_rows(query, rows, batch_size, "tweets")
+
+# Feeds are paged by keyset rather than by offset. A cursor is the
+# (tweeted_on, tweet_id) of the last tweet on the previous page, and the next
+# page starts right after it, so a deep scroll costs the same as the first page.
+# tweeted_on is an ISO string, which sorts the same way as the dates do.
+
+FEED_PAGE_SIZE = 25
+
+# Sorts after every real tweet, so passing it returns the newest page.
+FIRST_PAGE = ("9999", "")
+
+def create_indexes():
+    """Creates the constraints and indexes the feed queries and bulk imports rely
+    on. The uniqueness constraints also index handle and tweet_id. Safe to run
+    more than once."""
+    GRAPH.run("CREATE CONSTRAINT ON (u:User) ASSERT u.handle IS UNIQUE;")
+    GRAPH.run("CREATE CONSTRAINT ON (t:Tweet) ASSERT t.tweet_id IS UNIQUE;")
+    GRAPH.run("CREATE INDEX ON :Tweet(tweeted_on);")
+
+def get_feed_page(handle=None, before=FIRST_PAGE, limit=FEED_PAGE_SIZE):
+    """Gets one page of tweets older than the 'before' cursor, newest first,
+    with the author's handle and name in the same result. If a handle is
+    given only tweets from the accounts that user follows are returned.
+
+    returns: a cursor of records with 't', 'handle' and 'name' fields.
+    """
+    before_on, before_id = before
+    if handle is None:
+        match = "MATCH (a:User)-[:TWEETED]->(t:Tweet)"
+    else:
+        match = "MATCH (:User {handle: {handle}})-[:FOLLOWS]->(a:User)-[:TWEETED]->(t:Tweet)"
+
+    # The first condition is a range seek on the tweeted_on index, the second
+    # breaks ties between tweets sent at the same moment.
+    query = match + """
+        WHERE t.tweeted_on <= {before_on}
+          AND (t.tweeted_on < {before_on} OR t.tweet_id < {before_id})
+        RETURN t, a.handle AS handle, a.name AS name
+        ORDER BY t.tweeted_on DESC, t.tweet_id DESC
+        LIMIT {limit};
+    """
+    return GRAPH.run(query, handle=handle, before_on=before_on,
+                     before_id=before_id, limit=limit)
+
+def next_page(record):
+    """Returns the cursor for the page after the one this record is the last of."""
+    return (record['t']['tweeted_on'], record['t']['tweet_id'])
+
+def get_full_feed(before=FIRST_PAGE):
     """Gets the most recent tweets as a cursor"""
-    query = "MATCH (t:Tweet) RETURN t ORDER BY t.tweeted_on DESC LIMIT 25;"
-    return GRAPH.run(query)
+    return get_feed_page(before=before)
 
-def get_user_feed(handle):
+def get_user_feed(handle, before=FIRST_PAGE):
     """Gets the most recent tweets only from the accounts that the account
     specified by the handle parameter follow"""
+    return get_feed_page(handle, before)
+
+# Fan-out on write. Instead of building a user's feed when they read it, every
+# tweet is pushed into its author's followers' timelines when it is sent, and
+# reading a page is just slicing the timeline. Timelines only keep the newest
+# TIMELINE_SIZE tweets. Authors with more than FAN_OUT_LIMIT followers are not
+# pushed (that would be too many writes per tweet); their tweets are pulled at
+# read time and merged in. Set TIMELINE_STORE to None to only use the pull model.
+#
+# Timeline entries are "tweeted_on tweet_id" strings, which sort the same way
+# the (tweeted_on, tweet_id) feed cursors do.
+
+TIMELINE_SIZE = 800
+FAN_OUT_LIMIT = 10000
+
+def timeline_key(tweeted_on, tweet_id):
+    return "{} {}".format(tweeted_on, tweet_id)
+
+class GraphTimelineStore:
+    """Keeps each timeline as a capped list property on the follower's User node."""
+
+    def fan_out(self, handle, key):
+        # Setting _lock first takes the write lock on the follower, so two
+        # tweets being pushed at the same time can't overwrite each other.
+        query = """
+            MATCH (u:User {handle: {handle}})
+            WHERE size((u)<-[:FOLLOWS]-()) <= {fan_out_limit}
+            MATCH (u)<-[:FOLLOWS]-(f:User)
+            SET f._lock = true
+            SET f.timeline = ([{key}] + coalesce(f.timeline, []))[0..{size}]
+            REMOVE f._lock;
+        """
+        GRAPH.run(query, handle=handle, key=key,
+                  fan_out_limit=FAN_OUT_LIMIT, size=TIMELINE_SIZE)
+
+    def page(self, handle, before_key, limit):
+        query = """
+            MATCH (u:User {handle: {handle}})
+            RETURN [k IN coalesce(u.timeline, []) WHERE k < {before}][0..{limit}];
+        """
+        return GRAPH.evaluate(query, handle=handle, before=before_key, limit=limit) or []
+
+class MemoryTimelineStore:
+    """Keeps timelines in this process. Handy for testing, or as a template for
+    another store (e.g. a Redis list per user with LPUSH and LTRIM)."""
+
+    def __init__(self):
+        self.timelines = {}
+
+    def fan_out(self, handle, key):
+        query = """
+            MATCH (u:User {handle: {handle}})
+            WHERE size((u)<-[:FOLLOWS]-()) <= {fan_out_limit}
+            MATCH (u)<-[:FOLLOWS]-(f:User)
+            RETURN f.handle;
+        """
+        for record in GRAPH.run(query, handle=handle, fan_out_limit=FAN_OUT_LIMIT):
+            timeline = self.timelines.setdefault(record[0], deque(maxlen=TIMELINE_SIZE))
+            timeline.appendleft(key)
+
+    def page(self, handle, before_key, limit):
+        keys = (k for k in self.timelines.get(handle, ()) if k < before_key)
+        return list(islice(keys, limit))
+
+# None means every feed read uses the pull model (get_user_feed).
+TIMELINE_STORE = None
+
+def get_timeline(handle, before=FIRST_PAGE, limit=FEED_PAGE_SIZE):
+    """Same as get_user_feed(), but reads from the materialized timeline when
+    fan-out is turned on. Tweets from accounts too big to fan out are pulled
+    and merged in.
+
+    returns: a list of records with 't', 'handle' and 'name' fields.
+    """
+    if TIMELINE_STORE is None:
+        return list(get_user_feed(handle, before))
+
+    keys = TIMELINE_STORE.page(handle, timeline_key(*before), limit)
+    tweet_ids = [key.split(" ")[1] for key in keys]
+
+    # The ORDER BY and LIMIT only apply to the pulled half of the UNION, the
+    # two halves are merged in python below.
+    before_on, before_id = before
     query = """
-        MATCH (t:Tweet)<-[:TWEETED]-(u)
-        WHERE (:User {handle: {handle}})-[:FOLLOWS]->(u)
-        RETURN t ORDER BY t.tweeted_on DESC LIMIT 25;
+        UNWIND {tweet_ids} AS tweet_id
+        MATCH (a:User)-[:TWEETED]->(t:Tweet {tweet_id: tweet_id})
+        RETURN t, a.handle AS handle, a.name AS name
+        UNION
+        MATCH (:User {handle: {handle}})-[:FOLLOWS]->(a:User)-[:TWEETED]->(t:Tweet)
+        WHERE size((a)<-[:FOLLOWS]-()) > {fan_out_limit}
+          AND t.tweeted_on <= {before_on}
+          AND (t.tweeted_on < {before_on} OR t.tweet_id < {before_id})
+        RETURN t, a.handle AS handle, a.name AS name
+        ORDER BY t.tweeted_on DESC, t.tweet_id DESC
+        LIMIT {limit};
     """
-    return GRAPH.run(query, handle=handle)
+    records = list(GRAPH.run(query, tweet_ids=tweet_ids, handle=handle,
+                             fan_out_limit=FAN_OUT_LIMIT, before_on=before_on,
+                             before_id=before_id, limit=limit))
+    records.sort(key=next_page, reverse=True)
+    return records[:limit]
 
 def get_author(tweet_id):
     """Helper method to get the author of a tweet"""
@@ -139,11 +384,51 @@ def get_author(tweet_id):
     """
     return GRAPH.run(query, tweet_id=tweet_id)
 
-def format_tweet(tweet_node):
-    """Helper method to take a tweet node and print it out"""
+# Authors are cached by handle so showing a tweet doesn't need its own query.
+# Anything that changes a user's profile has to invalidate their entry.
+AUTHOR_CACHE = LRUCache(maxsize=10000)
 
-    author = next(get_author(tweet_node['tweet_id']))
-    print("{} - {}".format(author.get('name', author['handle'][1:]), author['handle']))
+def get_user_info(handle):
+    """Gets the handle and name of a user, only querying on a cache miss.
+
+    returns: a dict with 'handle' and 'name', or None if the user doesn't exist
+    """
+    def load():
+        query = """
+            MATCH (a:User {handle: {handle}})
+            RETURN a.handle as handle, a.name as name;
+        """
+        rows = GRAPH.run(query, handle=handle).data()
+        return rows[0] if rows else None
+
+    return AUTHOR_CACHE.get_or_load(handle, load)
+
+def cache_authors(records):
+    """Stores the authors that came back with a feed page (see get_feed_page)
+    in the cache, and returns the records so they can be looped over."""
+    records = list(records)
+    for record in records:
+        AUTHOR_CACHE.put(record['handle'], {"handle": record['handle'], "name": record['name']})
+    return records
+
+def update_user(handle, **kwargs):
+    """Changes properties on a user's profile, e.g. update_user("@nickj", name="Nick")"""
+    query = """
+        MATCH (u:User {handle: {handle}})
+        SET u += {props};
+    """
+    GRAPH.run(query, handle=handle, props=kwargs)
+    AUTHOR_CACHE.invalidate(handle)
+
+def format_tweet(tweet_node, handle=None):
+    """Helper method to take a tweet node and print it out. If the author's
+    handle is known the author comes from the cache instead of a query."""
+
+    if handle is not None:
+        author = get_user_info(handle)
+    else:
+        author = next(get_author(tweet_node['tweet_id']))
+    print("{} - {}".format(author.get('name') or author['handle'][1:], author['handle']))
     print(tweet_node['text'])
     print("Likes: {}\tTweeted on: {}".format(tweet_node['num_likes'], tweet_node['tweeted_on']))
 
@@ -168,14 +453,27 @@ def run():
     print("(q)uit")
     print()
 
-    tweets = get_full_feed()
+    create_indexes()
+    tweets = iter(cache_authors(get_full_feed()))
+    cursor = FIRST_PAGE
+    shown = 0
     while True:
         try:
-            current_tweet = next(tweets)['t']
-            format_tweet(current_tweet)
+            record = next(tweets)
+            current_tweet = record['t']
+            cursor = next_page(record)
+            shown += 1
+            format_tweet(current_tweet, record['handle'])
         except StopIteration:
-            print("No more tweets, fetching new ones")
-            tweets = get_full_feed()
+            # Only a full page can have older tweets after it. Anything less
+            # means we've scrolled past the oldest tweet.
+            if shown < FEED_PAGE_SIZE:
+                print("No more tweets, fetching new ones")
+                cursor = FIRST_PAGE
+            else:
+                print("Fetching older tweets")
+            tweets = iter(cache_authors(get_full_feed(cursor)))
+            shown = 0
             input("(hit enter to continue): ")
             current_tweet = None
 
@@ -196,7 +494,9 @@ def run():
         # Refresh
         elif option.lower() in ["refresh", "r"]:
             print("Refreshing tweets...")
-            tweets = get_full_feed()
+            tweets = iter(cache_authors(get_full_feed()))
+            cursor = FIRST_PAGE
+            shown = 0
 
         # Follow
         elif option.lower() in ["follow", "f"]:
@@ -1,9 +1,19 @@
 """Basic querying with neo4j. Checking the relationship of words in Hamlet"""
 
+import glob
+import os
 import random
-from py2neo import Graph
+from array import array
+from collections import Counter, deque
+from functools import partial
+from multiprocessing import Pool
 
-GRAPH = Graph(password="password")
+from cache import LRUCache
+from connections import neo4j_graph
+
+# Connects on first use, so Pool workers that never touch the database
+# don't open a connection. See connections.py.
+GRAPH = neo4j_graph("shakespeare", password="password")
 
 # Queries for creating the database
 
@@ -29,46 +39,276 @@ def comes_after(after_word, before_word):
     """
     GRAPH.run(query, word1=after_word, word2=before_word)
 
-def create():
-    """Creates the graph. DO NOT RUN TWICE or the numbers will get messed upself.
+HAMLET = "TextDocs/shakespeare-hamlet-25.txt"
+
+# Parsing is split up into a pipeline of generators, each stage feeding the
+# next. Only one phrase is held in memory at a time, so the size of the text
+# doesn't matter.
+
+def read_lines(filename):
+    """Stage 1: streams the file one line at a time."""
+    with open(filename) as f:
+        for line in f:
+            yield line.rstrip('\n')
+
+def split_phrases(lines):
+    """Stage 2: groups lines into phrases. Phrases are separated by a blank line."""
+    phrase = []
+    for line in lines:
+        if line:
+            phrase.append(line)
+        elif phrase:
+            yield "\n".join(phrase)
+            phrase = []
+    if phrase:
+        yield "\n".join(phrase)
 
-    Also it takes like a half hour to run on my computer. The merges don't help"""
+def resolve_speakers(phrases):
+    """Stage 3: skips everything before the first act, along with stage
+    directions and headings, and yields (voice, text) for each spoken phrase.
+    Phrases without a speaker in capitals belong to whoever spoke last."""
     reserved = ["ACT", "SCENE", "["]
 
-    last = ""
     last_voice = ""
     start = False
-    with open("TextDocs/shakespeare-hamlet-25.txt") as f:
-        data = f.read()
-        phrases = data.split("\n\n")
-        for phrase in phrases:
-            if phrase[:3] == "ACT":
-                start = True
-
-            if start:
-                p = phrase.strip()
-                for r in reserved:
-                    if p.startswith(r):
-                        break
-                else:
-                    s = p.split('\t')
-                    voice, text = s[0], "".join(s[1:]).replace('\n', ' ')
-                    if not voice.isupper():
-                        voice = last_voice
-                    for word in [t for t in text.split(' ') if len(t) > 0]:
-                        if not word[-1].isalpha():
-                            final = word[:-1]
-                        else:
-                            final = word
-                        final = final.lower()
-                        # print("{},{}".format(voice, final.lower()))
-                        # Add to the database here
-                        says(voice, final)
-                        comes_after(final, last)
-
-                        last = final
-
-                    last_voice = voice
+    for phrase in phrases:
+        if phrase[:3] == "ACT":
+            start = True
+
+        if start:
+            p = phrase.strip()
+            for r in reserved:
+                if p.startswith(r):
+                    break
+            else:
+                s = p.split('\t')
+                voice, text = s[0], "".join(s[1:]).replace('\n', ' ')
+                if not voice.isupper():
+                    voice = last_voice
+                yield voice, text
+
+                last_voice = voice
+
+def tokenize(spoken):
+    """Stage 4: splits each phrase into lowercase words with the trailing
+    punctuation taken off, yielding (voice, word)."""
+    for voice, text in spoken:
+        for word in text.split(' '):
+            if not word:
+                continue
+            if not word[-1].isalpha():
+                word = word[:-1]
+            yield voice, word.lower()
+
+def parse_words(filename=HAMLET):
+    """Goes through the play and yields a (voice, word) tuple for every word
+    spoken, in the order they are spoken."""
+    return tokenize(resolve_speakers(split_phrases(read_lines(filename))))
+
+# Sinks take the tokens from parse_words() and do something with them. Each one
+# has an add(voice, word) method and a close(ok) method that is called at the
+# end. ok is False if the tokens stopped early because of an error, in which
+# case a sink shouldn't write out what it has so far.
+
+class CounterSink:
+    """Counts SAYS and COMES_AFTER pairs in memory. Memory grows with the number
+    of distinct pairs, not with the length of the text."""
+
+    def __init__(self):
+        self.says_counts = Counter()
+        self.after_counts = Counter()
+        self.last = ""
+
+    def add(self, voice, word):
+        self.says_counts[(voice, word)] += 1
+        self.after_counts[(word, self.last)] += 1
+        self.last = word
+
+    def close(self, ok=True):
+        pass
+
+class GraphSink(CounterSink):
+    """Counts everything up, then writes the totals into the graph in batches
+    when closed. See write_counts(). Nothing is written if the text wasn't read
+    to the end, since the counts are SET and partial ones would replace the
+    right ones."""
+
+    def __init__(self, batch_size=1000):
+        super().__init__()
+        self.batch_size = batch_size
+
+    def close(self, ok=True):
+        if ok:
+            create_indexes()
+            write_counts(self.says_counts, self.after_counts, self.batch_size)
+
+class FileSink:
+    """Writes one 'voice<tab>word' line per token."""
+
+    def __init__(self, filename):
+        self.file = open(filename, 'w')
+
+    def add(self, voice, word):
+        self.file.write("{}\t{}\n".format(voice, word))
+
+    def close(self, ok=True):
+        self.file.close()
+
+def feed(tokens, *sinks):
+    """Sends every (voice, word) token to each of the sinks, then closes them.
+    The tokens are only read once, no matter how many sinks there are. If
+    anything goes wrong (or it's interrupted) the sinks are still closed, but
+    told not to write anything."""
+    ok = False
+    try:
+        for voice, word in tokens:
+            for sink in sinks:
+                sink.add(voice, word)
+        ok = True
+    finally:
+        for sink in sinks:
+            sink.close(ok)
+    return sinks
+
+def create():
+    """Creates the graph. DO NOT RUN TWICE or the numbers will get messed upself.
+
+    Also it takes like a half hour to run on my computer. The merges don't help.
+    Use create_batched() instead, it does the same thing in a few seconds."""
+
+    last = ""
+    for voice, word in parse_words():
+        # Add to the database here
+        says(voice, word)
+        comes_after(word, last)
+
+        last = word
+
+# Batched version of create(). Instead of two MERGE queries per word we count
+# everything up in python first, then send the totals over in big chunks.
+
+def count_words(filename=HAMLET):
+    """Counts how many times each character says each word, and how many times
+    each word comes after another one.
+
+    returns: (says_counts, after_counts), two Counters keyed by
+             (voice, word) and (after_word, before_word) respectively.
+    """
+    sink = CounterSink()
+    feed(parse_words(filename), sink)
+    return sink.says_counts, sink.after_counts
+
+def chunks(rows, size):
+    """Splits an iterable up into lists of at most 'size' elements."""
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def create_indexes():
+    """Every batch MERGEs on these properties, so without an index each row
+    would have to scan every Word node."""
+    GRAPH.run("CREATE INDEX ON :Word(value);")
+    GRAPH.run("CREATE INDEX ON :Character(name);")
+
+def write_counts(says_counts, after_counts, batch_size=1000):
+    """Writes the counters from count_words() into the graph, one UNWIND query
+    per batch. The counts are SET rather than incremented, so writing the same
+    counts twice leaves the graph the same as writing them once."""
+
+    says_query = """
+        UNWIND {rows} AS row
+        MERGE (c:Character {name: row.voice})
+        MERGE (w:Word {value: row.word})
+        MERGE (c)-[s:SAYS]->(w)
+        SET s.count = row.count;
+    """
+    says_rows = ({"voice": voice, "word": word, "count": count}
+                 for (voice, word), count in says_counts.items())
+    for batch in chunks(says_rows, batch_size):
+        GRAPH.run(says_query, rows=batch)
+
+    after_query = """
+        UNWIND {rows} AS row
+        MERGE (w1:Word {value: row.word1})
+        MERGE (w2:Word {value: row.word2})
+        MERGE (w1)-[c:COMES_AFTER]->(w2)
+        SET c.count = row.count;
+    """
+    after_rows = ({"word1": after_word, "word2": before_word, "count": count}
+                  for (after_word, before_word), count in after_counts.items())
+    for batch in chunks(after_rows, batch_size):
+        GRAPH.run(after_query, rows=batch)
+
+def create_batched(filename=HAMLET, batch_size=1000):
+    """Creates the same graph as create(), but can be run as many times as you
+    want. Running it again on the same text won't change any of the counts."""
+    feed(parse_words(filename), GraphSink(batch_size))
+
+# Higher order chains. Instead of only looking at the last word, the next word
+# is picked based on the last 'order' words (its context). Contexts are stored
+# as their own nodes: (:Context {words: [...]})-[:FOLLOWED_BY {count}]->(:Word)
+
+def count_ngrams(filename, order=2):
+    """Counts how many times each word follows each context of 'order' words.
+    The start of the play is padded with empty words.
+
+    returns: a Counter keyed by (context, next_word), where context is a tuple.
+    """
+    counts = Counter()
+    context = deque([""] * order, maxlen=order)
+    for _, word in parse_words(filename):
+        counts[(tuple(context), word)] += 1
+        context.append(word)
+    return counts
+
+def write_ngrams(ngram_counts, order, batch_size=1000):
+    """Writes the merged n-gram counts into the graph. Like write_counts() the
+    counts are SET, so writing them twice is fine. Order 1 counts go into the
+    COMES_AFTER relationships that everything else already uses."""
+    if order == 1:
+        after_counts = Counter({(next_word, context[0]): count
+                                for (context, next_word), count in ngram_counts.items()})
+        create_indexes()
+        write_counts(Counter(), after_counts, batch_size)
+        return
+
+    create_indexes()
+    GRAPH.run("CREATE INDEX ON :Context(key);")
+    query = """
+        UNWIND {rows} AS row
+        MERGE (c:Context {key: row.key})
+        ON CREATE SET c.words = row.words, c.order = {order}
+        MERGE (w:Word {value: row.word})
+        MERGE (c)-[f:FOLLOWED_BY]->(w)
+        SET f.count = row.count;
+    """
+    # Words never contain spaces, so joining them makes a unique key.
+    rows = ({"key": " ".join(context), "words": list(context), "word": next_word, "count": count}
+            for (context, next_word), count in ngram_counts.items())
+    for batch in chunks(rows, batch_size):
+        GRAPH.run(query, rows=batch, order=order)
+
+def build_ngrams(directory="TextDocs", order=2, processes=None, batch_size=1000, write=True):
+    """Counts the n-grams of every play (*.txt) in a directory, one play per
+    worker process, merges the counts and writes them as one batched load.
+
+    returns: the merged Counter, which can go straight into MarkovChain.from_ngrams()
+    """
+    filenames = sorted(glob.glob(os.path.join(directory, "*.txt")))
+
+    merged = Counter()
+    with Pool(processes) as pool:
+        for counts in pool.imap_unordered(partial(count_ngrams, order=order), filenames):
+            merged.update(counts)
+
+    if write:
+        write_ngrams(merged, order, batch_size)
+    return merged
 
 # Queries on the finished database below
 
@@ -89,6 +329,16 @@ def get_next_words(word):
 
     return final
 
+# The same common words ("the", "and", "of") get looked up over and over, so
+# successor lookups go through a bounded cache. Set a ttl if the graph is being
+# changed while text is generated.
+NEXT_WORDS_CACHE = LRUCache(maxsize=2048, ttl=None)
+
+def cached_next_words(word):
+    """get_next_words(), but only queries the database on a cache miss. Hit and
+    miss counts are on NEXT_WORDS_CACHE.hits / NEXT_WORDS_CACHE.misses"""
+    return NEXT_WORDS_CACHE.get_or_load(word, lambda: get_next_words(word))
+
 def calc_next_word(next_words):
     # Basic markov chain
     val = random.uniform(0, max(next_words.values()))
@@ -98,21 +348,233 @@ def calc_next_word(next_words):
 
     return "No word?"
 
-def run():
+# Everything above makes one query per generated word. The class below loads the
+# whole chain once and generates text without touching the database.
+
+class MarkovChain:
+    """Markov chain built from the COMES_AFTER relationships (or from n-gram
+    counts, see build_ngrams()).
+
+    Words are interned as integer ids. A state is the context the next word is
+    picked from: the last word for a normal chain, or the last 'order' words
+    for a higher order one. The successors of every state are stored back to
+    back in flat arrays (state i's successors live between starts[i] and
+    starts[i+1]), along with an alias table so that picking the next word is
+    O(1) no matter how many successors there are. Each successor also stores
+    the state it leads to, so a higher order chain is just as fast to walk.
+    """
+
+    def __init__(self, transitions, seed=None):
+        """transitions is an iterable of (context, next_word, count) tuples.
+        context is a tuple of the words before next_word, or a single word."""
+        self.words = []
+        self.word_ids = {}
+        self.contexts = []
+        self.state_ids = {}
+        self.random = random.Random(seed)
+
+        successors = []
+        for context, next_word, count in transitions:
+            if isinstance(context, str):
+                context = (context,)
+            state = self.intern_state(tuple(self.intern(w) for w in context))
+            if state == len(successors):
+                successors.append([])
+            successors[state].append((self.intern(next_word), count))
+
+        self.order = len(self.contexts[0]) if self.contexts else 1
+
+        self.starts = array('l', [0])
+        self.successors = array('l')
+        self.next_states = array('l')
+        self.probs = array('d')
+        self.aliases = array('l')
+        for state, row in enumerate(successors):
+            probs, aliases = build_alias_table([count for _, count in row])
+            context = self.contexts[state][1:]
+            for next_id, _ in row:
+                self.successors.append(next_id)
+                # -1 means the chain has nowhere to go after this word.
+                self.next_states.append(self.state_ids.get(context + (next_id,), -1))
+            self.probs.extend(probs)
+            self.aliases.extend(aliases)
+            self.starts.append(len(self.successors))
+
+    @classmethod
+    def from_graph(cls, graph=GRAPH, order=1, seed=None):
+        """Loads the whole chain with a single query. Order 1 uses the
+        COMES_AFTER relationships, higher orders use the Context nodes written
+        by write_ngrams()."""
+        if order == 1:
+            query = """
+                MATCH (w2:Word)-[c:COMES_AFTER]->(w1:Word)
+                RETURN w1.value AS context, w2.value AS next_word, c.count AS count;
+            """
+        else:
+            query = """
+                MATCH (c:Context {order: {order}})-[f:FOLLOWED_BY]->(w:Word)
+                RETURN c.words AS context, w.value AS next_word, f.count AS count;
+            """
+        transitions = ((tuple(r['context']) if order > 1 else r['context'],
+                        r['next_word'], r['count'])
+                       for r in graph.run(query, order=order))
+        return cls(transitions, seed)
+
+    @classmethod
+    def from_counts(cls, after_counts, seed=None):
+        """Builds the chain straight from count_words(), no database needed."""
+        transitions = ((before_word, after_word, count)
+                       for (after_word, before_word), count in after_counts.items())
+        return cls(transitions, seed)
+
+    @classmethod
+    def from_ngrams(cls, ngram_counts, seed=None):
+        """Builds the chain straight from count_ngrams() or build_ngrams()."""
+        transitions = ((context, next_word, count)
+                       for (context, next_word), count in ngram_counts.items())
+        return cls(transitions, seed)
+
+    def intern(self, word):
+        """Returns the id for a word, giving it a new one if we haven't seen it."""
+        word_id = self.word_ids.get(word)
+        if word_id is None:
+            word_id = len(self.words)
+            self.word_ids[word] = word_id
+            self.words.append(word)
+        return word_id
+
+    def intern_state(self, context):
+        """Same as intern(), but for a tuple of word ids."""
+        state = self.state_ids.get(context)
+        if state is None:
+            state = len(self.contexts)
+            self.state_ids[context] = state
+            self.contexts.append(context)
+        return state
+
+    def find_state(self, context):
+        """Returns the state for a word (or tuple of words), or -1 if it isn't
+        in the chain."""
+        if isinstance(context, str):
+            context = (context,)
+        ids = tuple(self.word_ids.get(w, -1) for w in context)
+        return self.state_ids.get(ids, -1)
+
+    def pick(self, state):
+        """Picks one of the state's successors and returns its position in the
+        flat arrays, or -1 if there are none."""
+        start = self.starts[state]
+        size = self.starts[state + 1] - start
+        if size == 0:
+            return -1
+
+        # One random number picks both the column and the coin flip.
+        r = self.random.random() * size
+        column = int(r)
+        if r - column < self.probs[start + column]:
+            return start + column
+        return start + self.aliases[start + column]
+
+    def next_word(self, context):
+        """Same idea as calc_next_word(get_next_words(word)), without the
+        queries. context is a word, or a tuple of 'order' words."""
+        state = self.find_state(context)
+        if state == -1:
+            return None
+        return self.words[self.successors[self.pick(state)]]
+
+    def sentence(self, start=None, max_length=100):
+        """Generates a string of words at most max_length characters long, the
+        same way run() does. start is a word (or a tuple of 'order' words for
+        a higher order chain). If it isn't given a random one is picked."""
+        if start is None:
+            state = self.random.randrange(len(self.contexts))
+        else:
+            state = self.find_state(start)
+            if state == -1:
+                return ""
+
+        words = []
+        length = 0
+        for word_id in self.contexts[state]:
+            word = self.words[word_id]
+            # The empty word marks the start of a play, don't print it.
+            if word:
+                length += len(word) + 1
+                words.append(word)
+
+        while state != -1:
+            position = self.pick(state)
+            if position == -1:
+                break
+            word = self.words[self.successors[position]]
+            length += len(word) + 1
+            if length > max_length:
+                break
+            words.append(word)
+            state = self.next_states[position]
+
+        return " ".join(words)
+
+    def sentences(self, count, start=None, max_length=100):
+        """Bulk version of sentence(). Yields 'count' sentences."""
+        for _ in range(count):
+            yield self.sentence(start, max_length)
+
+def build_alias_table(weights):
+    """Vose's alias method. Turns a list of weights into a probability table
+    and an alias table of the same length. To sample, pick a column i
+    uniformly, then keep i with probability probs[i], otherwise use aliases[i].
+    """
+    size = len(weights)
+    total = sum(weights)
+    probs = [0.0] * size
+    aliases = list(range(size))
+    if size == 0 or total <= 0:
+        return probs, aliases
+
+    scaled = [w * size / total for w in weights]
+    small = [i for i, p in enumerate(scaled) if p < 1.0]
+    large = [i for i, p in enumerate(scaled) if p >= 1.0]
+    while small and large:
+        less = small.pop()
+        more = large.pop()
+        probs[less] = scaled[less]
+        aliases[less] = more
+        scaled[more] = scaled[more] + scaled[less] - 1.0
+        if scaled[more] < 1.0:
+            small.append(more)
+        else:
+            large.append(more)
+
+    # Anything left over is 1 (give or take some floating point error).
+    for i in small + large:
+        probs[i] = 1.0
+
+    return probs, aliases
+
+def run(chain=None):
     """Shakespeare text generator. It would have made sense to keep words with punctuation,
     but since I didn't this creates a long run on sentance. it can be as long as you would
     like, just adjust the 100 below to any length you want (it is the maximum length of
-    the string)"""
+    the string)
+
+    If a MarkovChain is passed in it is used instead of querying for every word."""
 
     previous_word = "ophelia"
+    if chain is not None:
+        print(chain.sentence(previous_word, 100))
+        print()
+        return
+
     #for _ in range(5):
     words = ""
     while len(words + previous_word) < 100:
         words += previous_word + ' '
-        previous_word = calc_next_word(get_next_words(previous_word))
+        previous_word = calc_next_word(cached_next_words(previous_word))
     print(words)
     print()
 
 if __name__ == "__main__":
-    #create() # Uncomment this if you haven't set up the graph yet.
-    run()
+    #create_batched() # Uncomment this if you haven't set up the graph yet.
+    run(MarkovChain.from_graph())